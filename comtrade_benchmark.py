@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Offline benchmark of the downloader in uncomtrade_cleaned-7.py against the local mock server (comtrade_mock_server.py).
+
+Every scenario downloads the same job in a fresh process and reports rows per second, peak memory (RSS) and the number
+of API calls of the job, so that changes to the downloader can be compared without touching the live API.
+
+Usage: python comtrade_benchmark.py [--scenarios sequential,workers] [--save results.json] [--baseline results.json]
+With --baseline the run fails (exit code 1) if a scenario is slower or uses more memory or calls than the baseline
+by more than --tolerance. A scenario that fails (e.g. the parse processes of the pipeline cannot run the downloader,
+so that it parses in-process instead) fails the run too.
+"""
+
+import argparse
+import importlib.abc
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+downloader_path = os.path.join(here, 'uncomtrade_cleaned-7.py')
+# module name of the downloader; not 'uncomtrade_cleaned', which is the notebook (JSON) uncomtrade_cleaned.py next to it
+downloader_module = 'comtrade_downloader'
+
+# job downloaded by every scenario: 5 partners x 12 months x rows_per_cell products
+job = {'period': '201801-201812', 'frequency': 'M', 'reporter': '842', 'partner': ['1', '2', '3', '4', '5'],
+       'product': 'all', 'tradeflow': 'exports'}
+
+# options of download_trade_data per scenario
+scenarios = {
+    'sequential': {},
+    'workers': {'workers': 4},
+    'stream': {'stream': True, 'chunk_size': 5000},
+    'pipeline': {'workers': 4, 'pipeline': True, 'parse_workers': 2},
+    'parquet': {'workers': 4, 'output_format': 'parquet'},
+}
+
+
+class DownloaderFinder(importlib.abc.MetaPathFinder):
+    """
+    makes the downloader importable as downloader_module: the parse processes of the pipeline look the functions up by
+    module name, and with the start methods spawn and forkserver they do not inherit the module from the parent
+    (they import this file first, which installs the finder)
+    """
+    def find_spec(self, name, path=None, target=None):
+        if name == downloader_module:
+            return importlib.util.spec_from_file_location(name, downloader_path)
+        return None
+
+
+sys.meta_path.append(DownloaderFinder())
+
+
+def load_downloader(path=downloader_path):
+    """
+    imports the functions of the downloader (the driver only runs as __main__)
+    output: module
+    """
+    spec = importlib.util.spec_from_file_location(downloader_module, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_scenario(name, base_url, rows_per_cell, start_method=None):
+    """
+    downloads the job with the options of the scenario (called in a fresh process, see measure)
+    start_method: start method of the parse processes of the pipeline ('fork', 'spawn' or 'forkserver', default: Python's)
+    output: dictionary with rows, seconds, rows_per_sec, calls and peak_rss_mb
+    """
+    if start_method:
+        import multiprocessing
+        multiprocessing.set_start_method(start_method)
+    ct = load_downloader()
+    ct.base_url = base_url
+    ct.api_limits['max'] = 10 * rows_per_cell # several calls per job, as with the real limit of 100000 rows
+    limiter = ct.mk_rate_limiter(rps=1000, rph=10**6)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        options = scenarios[name]
+        filename = os.path.join(tmp, 'job' if options.get('output_format') else 'job.csv')
+        start = time.perf_counter()
+        calls = ct.download_trade_data(filename, verbose=False, limiter=limiter, session=ct.mk_session(), **job, **options)
+        seconds = time.perf_counter() - start
+        fallbacks = ct.metric_total(ct.download_metrics, 'comtrade_parse_fallbacks_total')
+        if fallbacks:
+            raise RuntimeError('{} responses were parsed in-process because the parse processes failed'.format(fallbacks))
+        if options.get('output_format'):
+            import pyarrow.dataset as ds
+            rows = ds.dataset(filename, format='parquet', partitioning='hive').count_rows()
+        else:
+            with open(filename) as f:
+                rows = sum(1 for _ in f) - 1
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {'rows': rows, 'seconds': round(seconds, 3), 'rows_per_sec': round(rows / seconds),
+            'calls': calls, 'peak_rss_mb': round(peak_rss / 1024**2, 1)}
+
+
+def measure(name, base_url, rows_per_cell, start_method=None):
+    """
+    runs a scenario in a new interpreter so that the peak memory of one scenario does not hide that of another
+    output: results of run_scenario, or dictionary with the last line of the error output ('error') if the scenario failed
+    """
+    out = subprocess.run([sys.executable, __file__, '--child', name, '--base-url', base_url,
+                          '--rows-per-cell', str(rows_per_cell)] + (['--start-method', start_method] if start_method else []),
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        return {'error': (out.stderr.strip().splitlines() or ['exit code {}'.format(out.returncode)])[-1]}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def start_server(rows_per_cell, latency):
+    """
+    starts comtrade_mock_server.py in its own process on a free port
+    output: (process, base_url)
+    """
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen([sys.executable, os.path.join(here, 'comtrade_mock_server.py'), '--port', str(port),
+                               '--rows-per-cell', str(rows_per_cell), '--latency', str(latency)], stdout=subprocess.DEVNULL)
+    for _ in range(100): # wait until the server accepts connections
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return server, 'http://127.0.0.1:{}/api/get?'.format(port)
+
+
+def compare(results, baseline, tolerance):
+    """
+    output: list of regressions, i.e. metrics that are worse than in the baseline by more than the tolerance (e.g. 0.2 = 20 %)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline or 'error' in result or 'error' in baseline[name]:
+            continue
+        for metric, higher_is_better in [('rows_per_sec', True), ('peak_rss_mb', False), ('calls', False)]:
+            old, new = baseline[name][metric], result[metric]
+            worse = new < old * (1 - tolerance) if higher_is_better else new > old * (1 + tolerance)
+            if worse:
+                regressions.append('{}: {} {} -> {}'.format(name, metric, old, new))
+    return regressions
+
+
+def print_results(results):
+    print('{:<12} {:>9} {:>9} {:>12} {:>6} {:>13}'.format('scenario', 'rows', 'seconds', 'rows/sec', 'calls', 'peak RSS (MB)'))
+    for name, r in results.items():
+        if 'error' in r:
+            print('{:<12} FAILED: {}'.format(name, r['error']))
+        else:
+            print('{:<12} {rows:>9} {seconds:>9} {rows_per_sec:>12} {calls:>6} {peak_rss_mb:>13}'.format(name, **r))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Comtrade downloader')
+    parser.add_argument('--scenarios', default=','.join(scenarios), help='comma separated, out of ' + ', '.join(scenarios))
+    parser.add_argument('--rows-per-cell', type=int, default=1000, help='products per reporter/ partner/ period')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the mock server delays every answer')
+    parser.add_argument('--save', help='file the results are saved in (json)')
+    parser.add_argument('--baseline', help='results of an earlier run (json) to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--start-method', choices=['fork', 'spawn', 'forkserver'],
+                        help='start method of the parse processes (default: the platform default)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.base_url, args.rows_per_cell, args.start_method)))
+        sys.exit(0)
+
+    server, base_url = start_server(args.rows_per_cell, args.latency)
+    try:
+        results = {name: measure(name, base_url, args.rows_per_cell, args.start_method) for name in args.scenarios.split(',')}
+    finally:
+        server.terminate()
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    failed = [name for name, result in results.items() if 'error' in result]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+    sys.exit(1 if regressions or failed else 0)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Local stand-in for the UN Comtrade API (https://comtrade.un.org/api/get), for testing and benchmarking the downloader
+in uncomtrade_cleaned-7.py without the rate limited live endpoint.
+
+It answers /api/get with the same parameters (ps, freq, r, p, cc, rg, px, type, fmt, max, head), a 'validation' block
+with the number of records and synthetic records, as json (fmt=json) or csv (fmt=csv, head=H/M). It also serves the
+area lists /data/cache/reporterAreas.json and /data/cache/partnerAreas.json.
+
+Usage: python comtrade_mock_server.py --port 8080 --rows-per-cell 100 --latency 0.2 --rph 100 --error-rate 0.01
+and point the downloader at it with base_url = 'http://localhost:8080/api/get?'
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# number of codes the wildcard ALL stands for
+n_areas = 250
+n_years = 30
+n_products = 6750
+
+# machine readable ('M') and human readable ('H') headings of the fields of a record
+fields = [
+    ('pfCode', 'Classification'), ('yr', 'Year'), ('period', 'Period'), ('periodDesc', 'Period Desc.'),
+    ('aggrLevel', 'Aggregate Level'), ('IsLeaf', 'Is Leaf Code'), ('rgCode', 'Trade Flow Code'), ('rgDesc', 'Trade Flow'),
+    ('rtCode', 'Reporter Code'), ('rtTitle', 'Reporter'), ('rt3ISO', 'Reporter ISO'),
+    ('ptCode', 'Partner Code'), ('ptTitle', 'Partner'), ('pt3ISO', 'Partner ISO'),
+    ('ptCode2', '2nd Partner Code'), ('ptTitle2', '2nd Partner'), ('pt3ISO2', '2nd Partner ISO'),
+    ('cstCode', 'Customs Proc. Code'), ('cstDesc', 'Customs'), ('motCode', 'Mode of Transport Code'), ('motDesc', 'Mode of Transport'),
+    ('cmdCode', 'Commodity Code'), ('cmdDescE', 'Commodity'),
+    ('qtCode', 'Qty Unit Code'), ('qtDesc', 'Qty Unit'), ('qtAltCode', 'Alt Qty Unit Code'), ('qtAltDesc', 'Alt Qty Unit'),
+    ('TradeQuantity', 'Qty'), ('AltQuantity', 'Alt Qty'), ('NetWeight', 'Netweight (kg)'), ('GrossWeight', 'Gross weight (kg)'),
+    ('TradeValue', 'Trade Value (US$)'), ('CIFValue', 'CIF Trade Value (US$)'), ('FOBValue', 'FOB Trade Value (US$)'),
+    ('estCode', 'Flag'),
+]
+
+trade_flows = {1: 'Import', 2: 'Export', 3: 'Re-Export', 4: 'Re-Import'}
+
+
+def mk_state(rows_per_cell=100, latency=0.0, rph=None, error_rate=0.0, seed=0):
+    """
+    settings and counters of the mock server
+    rows_per_cell: number of products per reporter/ partner/ period when cc=ALL (at most n_products)
+    latency: seconds every answer is delayed
+    rph: number of requests per hour and token (parameter 'token', none = guest) before the server answers with 409 (None = no limit)
+    error_rate: share of requests answered with 500
+    """
+    return {
+        'rows_per_cell': min(rows_per_cell, n_products),
+        'latency': latency,
+        'rph': rph,
+        'error_rate': error_rate,
+        'random': random.Random(seed),
+        'requests': {}, # token -> times of its requests of the last hour
+        'stats': {'requests': 0, 'throttled': 0, 'errors': 0, 'rows': 0, 'bytes': 0},
+        'lock': threading.Lock(),
+    }
+
+
+def expand_codes(values, wildcard):
+    """
+    input: comma separated codes of one parameter and the codes that ALL stands for
+    output: list of codes
+    """
+    codes = values.split(',')
+    return wildcard if any(c.lower() == 'all' for c in codes) else codes
+
+
+def expand_periods(values, frequency):
+    periods = values.split(',')
+    if any(p.lower() in ['all', 'recent', 'now'] for p in periods):
+        n = {'all': n_years, 'recent': 5, 'now': 1}[periods[0].lower()]
+        years = range(2020 - n + 1, 2021)
+        periods = [str(y) for y in years] if frequency == 'A' else ['{}{:02d}'.format(y, m) for y in years for m in range(1, 13)]
+    return periods
+
+
+def expand_products(values, rows_per_cell):
+    products = []
+    for code in values.split(','):
+        if code.lower() == 'all':
+            products += ['{:06d}'.format(n) for n in range(rows_per_cell)]
+        elif code.lower() in ['ag2', 'ag4', 'ag6']:
+            digits = int(code[2])
+            products += ['{:0{}d}'.format(n, digits) for n in range(min(rows_per_cell, 10 ** digits))]
+        else:
+            products.append(code.upper())
+    return products
+
+
+def mk_record(reporter, partner, period, product, tradeflow):
+    """
+    output: synthetic record (dictionary with machine readable headings); values depend only on the codes
+    """
+    value = zlib.crc32('{}|{}|{}|{}|{}'.format(reporter, partner, period, product, tradeflow).encode()) % 10**9
+    return {
+        'pfCode': 'H4', 'yr': int(str(period)[:4]), 'period': int(period), 'periodDesc': str(period),
+        'aggrLevel': 0 if product == 'TOTAL' else len(product), 'IsLeaf': int(len(product) == 6),
+        'rgCode': int(tradeflow), 'rgDesc': trade_flows.get(int(tradeflow), 'Other'),
+        'rtCode': int(reporter), 'rtTitle': 'Reporter {}'.format(reporter), 'rt3ISO': 'R{:02d}'.format(int(reporter) % 100),
+        'ptCode': int(partner), 'ptTitle': 'Partner {}'.format(partner), 'pt3ISO': 'P{:02d}'.format(int(partner) % 100),
+        'ptCode2': None, 'ptTitle2': '', 'pt3ISO2': '', 'cstCode': '', 'cstDesc': '', 'motCode': '', 'motDesc': '',
+        'cmdCode': product, 'cmdDescE': 'Commodity {}'.format(product),
+        'qtCode': 8, 'qtDesc': 'Weight in kilograms', 'qtAltCode': None, 'qtAltDesc': '',
+        'TradeQuantity': value % 100000, 'AltQuantity': None, 'NetWeight': value % 100000, 'GrossWeight': None,
+        'TradeValue': value, 'CIFValue': None, 'FOBValue': None, 'estCode': 0,
+    }
+
+
+def answer_get(state, query):
+    """
+    output: (HTTP status, content type, body) for a request of /api/get with the parsed query string
+    """
+    param = lambda key, default: query.get(key, [default])[0]
+    frequency = param('freq', 'A').upper()
+    areas = [str(n) for n in range(1, n_areas + 1)]
+
+    reporters = expand_codes(param('r', '842'), areas)
+    partners = expand_codes(param('p', 'all'), areas)
+    periods = expand_periods(param('ps', 'recent'), frequency)
+    products = expand_products(param('cc', 'TOTAL'), state['rows_per_cell'])
+    tradeflows = expand_codes(param('rg', '2'), ['1', '2'])
+    max_rows = int(param('max', '500'))
+    fmt = param('fmt', 'json').lower()
+    head = param('head', 'H').upper()
+
+    n_wildcards = sum(any(c.lower() == 'all' for c in param(key, '').split(',')) for key in ['r', 'p', 'ps'])
+    if n_wildcards > 1:
+        return 400, 'application/json', json.dumps({'validation': {'status': {'name': 'Invalid'},
+            'message': 'Only one of r, p and ps may use ALL.', 'count': {'value': 0}}, 'dataset': []})
+
+    total = len(reporters) * len(partners) * len(periods) * len(products) * len(tradeflows)
+    cells = ((r, p, ps, cc, rg) for rg in tradeflows for r in reporters for ps in periods for p in partners for cc in products)
+    records = [mk_record(*cell) for _, cell in zip(range(max_rows), cells)]
+    message = 'Result truncated at {} rows.'.format(max_rows) if total > max_rows else None
+
+    if fmt == 'csv':
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow([m if head == 'M' else h for m, h in fields])
+        for record in records:
+            writer.writerow(['' if record[m] is None else record[m] for m, _ in fields])
+        return 200, 'text/csv', out.getvalue()
+
+    validation = {
+        'status': {'name': 'Ok', 'value': 0, 'category': 0, 'description': '', 'helpUrl': ''},
+        'message': message,
+        'count': {'value': total, 'started': None, 'finished': None, 'durationSeconds': 0},
+    }
+    return 200, 'application/json', json.dumps({'validation': validation, 'dataset': records})
+
+
+def throttled(state, token=None):
+    """
+    counts the request of the token and returns the number of seconds until requests may resume if its hourly limit has been hit
+    """
+    with state['lock']:
+        now = time.time()
+        requests = state['requests'][token] = [t for t in state['requests'].get(token, []) if t > now - 3600]
+        if state['rph'] is not None and len(requests) >= state['rph']:
+            return requests[0] + 3600 - now
+        requests.append(now)
+        return None
+
+
+def mk_handler(state):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1' # keep-alive
+
+        def send(self, status, content_type, body):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            with state['lock']:
+                state['stats']['bytes'] += len(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            with state['lock']:
+                state['stats']['requests'] += 1
+                failing = state['random'].random() < state['error_rate']
+            if state['latency']:
+                time.sleep(state['latency'])
+
+            if url.path.endswith('Areas.json'):
+                results = [{'id': 'all', 'text': 'All'}] + [{'id': str(n), 'text': 'Area {}'.format(n)} for n in range(1, n_areas + 1)]
+                return self.send(200, 'application/json', json.dumps({'more': False, 'results': results}))
+
+            if not url.path.endswith('/api/get'):
+                return self.send(404, 'text/plain', 'Not found')
+
+            wait = throttled(state, parse_qs(url.query).get('token', [None])[0])
+            if wait is not None:
+                with state['lock']:
+                    state['stats']['throttled'] += 1
+                resume = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=wait)
+                return self.send(409, 'text/plain', 'USAGE LIMIT: Hourly usage limit of {} actions reached. '
+                    'Requests may resume at {}'.format(state['rph'], resume.strftime('%Y-%m-%dT%H:%M:%SZ')))
+
+            if failing:
+                with state['lock']:
+                    state['stats']['errors'] += 1
+                return self.send(500, 'text/plain', 'Internal Server Error')
+
+            status, content_type, body = answer_get(state, parse_qs(url.query))
+            with state['lock']:
+                state['stats']['rows'] += body.count('\n') if content_type == 'text/csv' else body.count('"pfCode"')
+            self.send(status, content_type, body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_mock_server(port=0, **options):
+    """
+    starts the mock server on a background thread
+    options: see mk_state
+    output: (server, state); the URL to use as base_url is 'http://127.0.0.1:{port}/api/get?' with port = server.server_port
+    """
+    state = mk_state(**options)
+    server = ThreadingHTTPServer(('127.0.0.1', port), mk_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the UN Comtrade API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--rows-per-cell', type=int, default=100, help='products per reporter/ partner/ period for cc=ALL')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every answer is delayed')
+    parser.add_argument('--rph', type=int, default=None, help='requests per hour before answering 409')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 500')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server, state = start_mock_server(args.port, rows_per_cell=args.rows_per_cell, latency=args.latency,
+        rph=args.rph, error_rate=args.error_rate, seed=args.seed)
+    print('Mock Comtrade API on http://127.0.0.1:{}/api/get?'.format(server.server_port))
+    try:
+        while True:
+            time.sleep(60)
+            print(state['stats'])
+    except KeyboardInterrupt:
+        server.shutdown()
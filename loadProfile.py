@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+"""
+Load profiles for the sensor generator: the target rate of readings per second over time, and a pacer that sends the
+readings on schedule.
+
+   constant   rate
+   ramp       linear from startRate to rate within period seconds, then rate
+   step       the rates of steps, each for period seconds, then the last one
+   sine       diurnal cycle of period seconds around rate: rate * (1 + amplitude * sin(2 pi t / period))
+   poisson    readings arrive as a Poisson process with the mean rate; bursts of burstFactor * rate lasting burstSeconds
+              start at random, on average every burstEvery seconds
+
+The pacer keeps an absolute deadline for every reading (start time plus the sum of the gaps), so that late wake-ups of
+sleep and the time spent sending do not add up: the rate stays exact on average however long the generator runs.
+"""
+
+import bisect
+import math
+import random
+import time
+
+PROFILES = ["constant", "ramp", "step", "sine", "poisson"]
+
+def newProfile(mode="constant", rate=100.0, startRate=0.0, period=60.0, steps=None, amplitude=0.5,
+               burstEvery=60.0, burstSeconds=5.0, burstFactor=5.0, seed=None):
+   if mode not in PROFILES:
+      raise ValueError("unknown load profile {} (one of {})".format(mode, ", ".join(PROFILES)))
+   return {"mode": mode, "rate": float(rate), "startRate": float(startRate), "period": float(period),
+           "steps": [float(s) for s in steps or [rate]], "amplitude": amplitude, "burstEvery": burstEvery,
+           "burstSeconds": burstSeconds, "burstFactor": burstFactor, "random": random.Random(seed),
+           "burstStarts": [], "burstEnds": []}
+
+def inBurst(profile, t):
+   # bursts are drawn lazily up to t, so the profile gives the same bursts whatever order it is asked in
+   starts, ends = profile["burstStarts"], profile["burstEnds"]
+   while not starts or starts[-1] <= t:
+      start = (starts[-1] if starts else 0.0) + profile["random"].expovariate(1.0 / profile["burstEvery"])
+      starts.append(start)
+      ends.append(start + profile["burstSeconds"])
+   i = bisect.bisect_right(starts, t) - 1
+   return i >= 0 and t < ends[i]
+
+def rateAt(profile, t):
+   # output: target readings per second t seconds after the start
+   mode = profile["mode"]
+   if mode == "ramp":
+      if t >= profile["period"]:
+         return profile["rate"]
+      return profile["startRate"] + (profile["rate"] - profile["startRate"]) * t / profile["period"]
+   if mode == "step":
+      return profile["steps"][min(int(t // profile["period"]), len(profile["steps"]) - 1)]
+   if mode == "sine":
+      return max(profile["rate"] * (1 + profile["amplitude"] * math.sin(2 * math.pi * t / profile["period"])), 0.0)
+   if mode == "poisson" and inBurst(profile, t):
+      return profile["rate"] * profile["burstFactor"]
+   return profile["rate"]
+
+def newPacer(profile, maxLag=1.0, minSleep=0.001, idleTick=0.01):
+   """
+   maxLag: seconds the generator may fall behind the schedule; older readings are skipped instead of being sent
+   in one burst; minSleep: shorter waits are left out (the deadlines keep the rate exact)
+   """
+   now = time.monotonic()
+   return {"profile": profile, "start": now, "next": now, "maxLag": maxLag, "minSleep": minSleep, "idleTick": idleTick,
+           "readings": 0, "target": 0.0, "skipped": 0.0, "measured": now,
+           "reported": {"time": now, "readings": 0, "target": 0.0}}
+
+def measureTarget(pacer, now):
+   # readings the profile asks for up to now (integral of the target rate)
+   pacer["target"] += rateAt(pacer["profile"], now - pacer["start"]) * (now - pacer["measured"])
+   pacer["measured"] = now
+
+def pace(pacer, maxCount=1, deadline=None):
+   """
+   waits until the next reading is due, but not beyond deadline (time.monotonic(), e.g. when buffered readings have to
+   be flushed)
+   output: number of readings due now (1 to maxCount), to be sent without further waiting; 0 if the deadline came first
+   """
+   profile, count = pacer["profile"], 0
+   while True:
+      now = time.monotonic()
+      measureTarget(pacer, now)
+      wait = pacer["next"] - now
+      if wait > 0:
+         if count:
+            break
+         if deadline is not None and deadline < pacer["next"]:
+            time.sleep(max(deadline - now, 0))
+            break
+         if wait >= pacer["minSleep"]:
+            time.sleep(wait)
+            continue
+      elif -wait > pacer["maxLag"]:
+         pacer["skipped"] += rateAt(profile, now - pacer["start"]) * (-wait - pacer["maxLag"])
+         pacer["next"] = now - pacer["maxLag"]
+      rate = rateAt(profile, pacer["next"] - pacer["start"])
+      if rate <= 0:
+         pacer["next"] += pacer["idleTick"]
+         continue
+      pacer["next"] += profile["random"].expovariate(rate) if profile["mode"] == "poisson" else 1.0 / rate
+      count += 1
+      if count >= maxCount:
+         break
+   pacer["readings"] += count
+   return count
+
+def paceReport(pacer):
+   # output: achieved against target rate since the last report and since the start
+   now = time.monotonic()
+   measureTarget(pacer, now)
+   last = pacer["reported"]
+   seconds, total = max(now - last["time"], 1e-9), max(now - pacer["start"], 1e-9)
+   achieved, target = (pacer["readings"] - last["readings"]) / seconds, (pacer["target"] - last["target"]) / seconds
+   pacer["reported"] = {"time": now, "readings": pacer["readings"], "target": pacer["target"]}
+   return "{} profile: {:.0f} readings/s of {:.0f} target ({:.1f} %), overall {:.0f} of {:.0f} ({:.1f} %), {:.3f} s behind, {:.0f} skipped".format(
+      pacer["profile"]["mode"], achieved, target, 100.0 * achieved / target if target else 100.0,
+      pacer["readings"] / total, pacer["target"] / total, 100.0 * pacer["readings"] / pacer["target"] if pacer["target"] else 100.0,
+      max(now - pacer["next"], 0.0), pacer["skipped"])
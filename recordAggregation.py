@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+"""
+Packs many small readings into one Kinesis record and unpacks them again, using the aggregated record format of the
+Kinesis Producer Library (KPL), so that KCL consumers and the aws-kinesis-agg de-aggregation libraries read them too:
+
+   4 bytes   magic number F3 89 9A C2
+   n bytes   protobuf message AggregatedRecord
+  16 bytes   MD5 of the protobuf message
+
+   message AggregatedRecord {
+      repeated string partition_key_table     = 1;
+      repeated string explicit_hash_key_table = 2;
+      repeated Record records                 = 3;
+   }
+   message Record {
+      required uint64 partition_key_index     = 1;
+      optional uint64 explicit_hash_key_index = 2;
+      required bytes  data                    = 3;
+   }
+
+(https://github.com/awslabs/amazon-kinesis-producer/blob/master/aggregation-format.md)
+A record without the magic number is a plain record and is passed through unchanged by deaggregate.
+
+Usage as de-aggregator: python3 recordAggregation.py --stream RawStreamData [--shard shardId-000000000000]
+prints the readings of the records of the stream.
+"""
+
+import base64
+import hashlib
+import time
+import argparse
+
+MAGIC = b"\xf3\x89\x9a\xc2"
+DIGEST_SIZE = 16
+MAX_RECORD_BYTES = 1024 * 1024   # data and partition key of one Kinesis record
+DEFAULT_MAX_BYTES = 51200        # default AggregationMaxSize of the KPL
+
+SMALL_VARINTS = [bytes((value,)) for value in range(0x80)]   # tags, indexes and lengths are mostly below 128
+
+def encodeVarint(value):
+   if value < 0x80:
+      return SMALL_VARINTS[value]
+   out = bytearray()
+   while True:
+      byte = value & 0x7f
+      value >>= 7
+      if value:
+         out.append(byte | 0x80)
+      else:
+         out.append(byte)
+         return bytes(out)
+
+def decodeVarint(buf, pos):
+   result, shift = 0, 0
+   while True:
+      byte = buf[pos]
+      pos += 1
+      result |= (byte & 0x7f) << shift
+      if not byte & 0x80:
+         return result, pos
+      shift += 7
+
+def lengthDelimited(fieldNumber, payload):
+   return encodeVarint(fieldNumber << 3 | 2) + encodeVarint(len(payload)) + payload
+
+def varintField(fieldNumber, value):
+   return encodeVarint(fieldNumber << 3) + encodeVarint(value)
+
+def toBytes(value):
+   return value if isinstance(value, bytes) else value.encode("utf-8")
+
+def newAggregate(maxBytes=DEFAULT_MAX_BYTES):
+   # readings collected for one aggregated record; its partition key and explicit hash key are those of its first reading
+   return {"maxBytes": min(maxBytes, MAX_RECORD_BYTES), "partitionKeys": {}, "explicitHashKeys": {},
+           "records": [], "first": None, "size": len(MAGIC) + DIGEST_SIZE}
+
+def encodedRecord(aggregate, data, partitionKey, explicitHashKey=None):
+   # protobuf Record of one reading and the bytes the key tables grow by
+   extra = 0
+   pkIndex = aggregate["partitionKeys"].get(partitionKey)
+   if pkIndex is None:
+      pkIndex = len(aggregate["partitionKeys"])
+      extra += len(lengthDelimited(1, toBytes(partitionKey)))
+   fields = varintField(1, pkIndex)
+   if explicitHashKey is not None:
+      ehkIndex = aggregate["explicitHashKeys"].get(explicitHashKey)
+      if ehkIndex is None:
+         ehkIndex = len(aggregate["explicitHashKeys"])
+         extra += len(lengthDelimited(2, toBytes(explicitHashKey)))
+      fields += varintField(2, ehkIndex)
+   fields += lengthDelimited(3, toBytes(data))
+   return lengthDelimited(3, fields), extra
+
+def addUserRecord(aggregate, data, partitionKey, explicitHashKey=None):
+   """
+   adds a reading to the aggregate
+   output: the finished aggregated record (data, partition key, explicit hash key) if the reading did not fit any more
+   (the aggregate then holds only this reading), otherwise None
+   """
+   explicitHashKey = None if explicitHashKey is None else str(explicitHashKey)
+   encoded, extra = encodedRecord(aggregate, data, partitionKey, explicitHashKey)
+   finished = None
+   if aggregate["records"] and aggregate["size"] + extra + len(encoded) + len(toBytes(aggregatedKey(aggregate))) > aggregate["maxBytes"]:
+      finished = serializeAggregate(aggregate)
+      clearAggregate(aggregate)
+      encoded, extra = encodedRecord(aggregate, data, partitionKey, explicitHashKey)
+   if partitionKey not in aggregate["partitionKeys"]:
+      aggregate["partitionKeys"][partitionKey] = len(aggregate["partitionKeys"])
+   if explicitHashKey is not None and explicitHashKey not in aggregate["explicitHashKeys"]:
+      aggregate["explicitHashKeys"][explicitHashKey] = len(aggregate["explicitHashKeys"])
+   if not aggregate["records"]:
+      aggregate["first"] = (toBytes(data), partitionKey, explicitHashKey)
+   aggregate["records"].append(encoded)
+   aggregate["size"] += extra + len(encoded)
+   return finished
+
+def aggregatedKey(aggregate):
+   return next(iter(aggregate["partitionKeys"]), "")
+
+def clearAggregate(aggregate):
+   aggregate["partitionKeys"], aggregate["explicitHashKeys"], aggregate["records"], aggregate["first"] = {}, {}, [], None
+   aggregate["size"] = len(MAGIC) + DIGEST_SIZE
+
+def serializeAggregate(aggregate):
+   """
+   output: (data, partition key, explicit hash key or None) of the aggregated record of the readings collected so far
+   (a single reading is sent as a plain record, as the KPL does)
+   """
+   if len(aggregate["records"]) == 1:
+      return aggregate["first"]
+   return packAggregate(aggregate), aggregatedKey(aggregate), aggregate["first"][2]
+
+def packAggregate(aggregate):
+   message = b"".join(lengthDelimited(1, toBytes(key)) for key in aggregate["partitionKeys"])
+   message += b"".join(lengthDelimited(2, toBytes(key)) for key in aggregate["explicitHashKeys"])
+   message += b"".join(aggregate["records"])
+   return MAGIC + message + hashlib.md5(message).digest()
+
+def flushAggregate(aggregate):
+   # output: the aggregated record of the readings collected so far (None if there are none); the aggregate is emptied
+   if not aggregate["records"]:
+      return None
+   finished = serializeAggregate(aggregate)
+   clearAggregate(aggregate)
+   return finished
+
+def parseFields(message):
+   # yields (field number, value) of a protobuf message with varint and length-delimited fields
+   pos = 0
+   while pos < len(message):
+      key, pos = decodeVarint(message, pos)
+      fieldNumber, wireType = key >> 3, key & 7
+      if wireType == 0:
+         value, pos = decodeVarint(message, pos)
+      elif wireType == 2:
+         length, pos = decodeVarint(message, pos)
+         value, pos = message[pos:pos + length], pos + length
+      else:
+         raise ValueError("unsupported protobuf wire type {}".format(wireType))
+      yield fieldNumber, value
+
+def deaggregate(data, partitionKey=None, explicitHashKey=None):
+   """
+   output: list of (partition key, explicit hash key or None, data) of the readings in a Kinesis record; a record that is
+   not aggregated (no magic number or wrong checksum) is returned as the only reading, with the given keys
+   """
+   data = toBytes(data)
+   if not data.startswith(MAGIC) or len(data) < len(MAGIC) + DIGEST_SIZE:
+      return [(partitionKey, explicitHashKey, data)]
+   message, digest = data[len(MAGIC):-DIGEST_SIZE], data[-DIGEST_SIZE:]
+   if hashlib.md5(message).digest() != digest:
+      return [(partitionKey, explicitHashKey, data)]
+   partitionKeys, explicitHashKeys, records = [], [], []
+   for fieldNumber, value in parseFields(message):
+      if fieldNumber == 1:
+         partitionKeys.append(value.decode("utf-8"))
+      elif fieldNumber == 2:
+         explicitHashKeys.append(value.decode("utf-8"))
+      elif fieldNumber == 3:
+         records.append(dict(parseFields(value)))
+   return [(partitionKeys[record[1]], explicitHashKeys[record[2]] if 2 in record else None, record.get(3, b""))
+           for record in records]
+
+def readStream(conn, streamName, shardId=None, iteratorType="TRIM_HORIZON"):
+   # yields (shard, partition key, data) of every reading of the stream, following the shards as new records arrive
+   shards = [shardId] if shardId else [s["ShardId"] for s in conn.describe_stream(streamName)["StreamDescription"]["Shards"]]
+   iterators = dict((shard, conn.get_shard_iterator(streamName, shard, iteratorType)["ShardIterator"]) for shard in shards)
+   while iterators:
+      for shard in list(iterators):
+         response = conn.get_records(iterators[shard], limit=1000, b64_decode=False)   # binary data, decoded here
+         for record in response["Records"]:
+            for key, ehk, data in deaggregate(base64.b64decode(record["Data"]), record["PartitionKey"]):
+               yield shard, key, data
+         if response.get("NextShardIterator"):
+            iterators[shard] = response["NextShardIterator"]
+         else:
+            del iterators[shard]   # shard closed
+      time.sleep(1)   # GetRecords allows 5 calls per second and shard
+
+if __name__ == "__main__":
+   from boto import kinesis
+
+   parser = argparse.ArgumentParser(description="Prints the readings of the (aggregated) records of a Kinesis stream")
+   parser.add_argument("--stream", default="RawStreamData")
+   parser.add_argument("--region", default="us-east-1")
+   parser.add_argument("--shard", help="only this shard (default: all shards)")
+   parser.add_argument("--latest", action="store_true", help="only records arriving from now on")
+   args = parser.parse_args()
+
+   conn = kinesis.connect_to_region(args.region)
+   for shard, key, data in readStream(conn, args.stream, args.shard, "LATEST" if args.latest else "TRIM_HORIZON"):
+      print(shard, key, data.decode("utf-8", "replace"))
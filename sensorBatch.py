@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+# -*- coding: utf-8 -*-
+"""
+Readings of many sensors generated at once with NumPy: one call draws the values, the anomaly mask, the timestamps and
+the sensors of a whole batch, and the batch is encoded to the JSON readings of tempGenerator.py in one pass, so that
+generating costs little next to sending.
+
+   gen = newBatchGenerator(names, lowVals, highVals, anomalyLows, anomalyHighs, anomalyRate=0.01)
+   batch = generateBatch(gen, 1000)
+   records = encodeBatch(gen, batch)   # [b'{"iotName": "DemoSensor", "iotValue": 14}', ...]
+"""
+
+import json
+import time
+import numpy as np
+
+def newBatchGenerator(names, lowVals, highVals, anomalyLows, anomalyHighs, anomalyRate=0.01, seed=None):
+   # value ranges (inclusive) of every sensor, normal and anomalous; the sensors report in turn
+   return {"names": list(names), "low": np.asarray(lowVals, np.int64), "high": np.asarray(highVals, np.int64),
+           "anomalyLow": np.asarray(anomalyLows, np.int64), "anomalyHigh": np.asarray(anomalyHighs, np.int64),
+           "anomalyRate": anomalyRate, "rng": np.random.default_rng(seed), "next": 0,
+           # everything of the JSON reading before the value, as json.dumps writes it
+           "prefixes": [('{"iotName": ' + json.dumps(name) + ', "iotValue": ').encode("utf-8") for name in names]}
+
+def generateBatch(gen, n, start=None, interval=0.0):
+   """
+   n readings; timestamps from start (default now) interval seconds apart
+   output: dictionary of arrays sensor (index into the sensors), value, anomaly (mask) and timestamp (seconds since epoch)
+   """
+   sensor = (gen["next"] + np.arange(n)) % len(gen["names"])
+   gen["next"] = (gen["next"] + n) % len(gen["names"])
+   rng = gen["rng"]
+   anomaly = rng.random(n) < gen["anomalyRate"]
+   low = np.where(anomaly, gen["anomalyLow"][sensor], gen["low"][sensor])
+   high = np.where(anomaly, gen["anomalyHigh"][sensor], gen["high"][sensor])
+   return {"sensor": sensor, "value": rng.integers(low, high, endpoint=True), "anomaly": anomaly,
+           "timestamp": (time.time() if start is None else start) + interval * np.arange(n)}
+
+def encodeBatch(gen, batch, timestamps=False):
+   # output: list of the JSON readings (bytes), with the field timestamp (seconds, to the millisecond) if timestamps is True
+   prefixes = gen["prefixes"]
+   values = batch["value"].astype(bytes).tolist()
+   if timestamps:
+      stamps = np.round(batch["timestamp"], 3).astype(bytes).tolist()
+      return [prefixes[s] + v + b', "timestamp": ' + t + b"}" for s, v, t in zip(batch["sensor"].tolist(), values, stamps)]
+   return [prefixes[s] + v + b"}" for s, v in zip(batch["sensor"].tolist(), values)]
@@ -6,23 +6,373 @@
 import json
 import datetime
 import random
+import time
+import argparse
+import base64
+import csv
+import hashlib
+import bisect
 from boto import kinesis
+from boto.kinesis.exceptions import ProvisionedThroughputExceededException
+from recordAggregation import newAggregate, addUserRecord, flushAggregate, DEFAULT_MAX_BYTES
+from loadProfile import PROFILES, newProfile, newPacer, pace, paceReport
 
-kinesis = kinesis.connect_to_region("us-east-1")
+# limits of one PutRecords request (https://docs.aws.amazon.com/kinesis/latest/APIReference/API_PutRecords.html)
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+MAX_RECORD_BYTES = 1024 * 1024   # data and partition key of one record
+ANOMALY_RATE = 0.01
+HASH_KEY_SPACE = 2 ** 128        # partition keys are mapped to shards by the MD5 of the key as a 128 bit integer
 
 def getData(iotName, lowVal, highVal):
    data = {}
    data["iotName"] = iotName
-   data["iotValue"] = random.randint(lowVal, highVal) 
+   data["iotValue"] = random.randint(lowVal, highVal)
    return data
 
-while 1:
+def newBuffer(conn, streamName, maxRecords=MAX_BATCH_RECORDS, maxBytes=MAX_BATCH_BYTES, linger=0.1, retries=5):
+   # readings waiting to be sent with one PutRecords call; flushed when maxRecords or maxBytes is reached
+   # or when the oldest reading has waited linger seconds
+   return {"conn": conn, "stream": streamName, "maxRecords": min(maxRecords, MAX_BATCH_RECORDS),
+           "maxBytes": min(maxBytes, MAX_BATCH_BYTES), "linger": linger, "retries": retries,
+           "records": [], "bytes": 0, "oldest": None,
+           "stats": {"batches": 0, "requests": 0, "sent": 0, "resent": 0, "dropped": 0}}
+
+def addRecord(buffer, data, partitionKey, explicitHashKey=None):
+   data = data if isinstance(data, bytes) else data.encode("utf-8")
+   size = len(data) + len(partitionKey.encode("utf-8"))
+   if size > MAX_RECORD_BYTES:
+      raise ValueError("record of {} bytes exceeds the Kinesis limit of {} bytes".format(size, MAX_RECORD_BYTES))
+   if buffer["records"] and (len(buffer["records"]) >= buffer["maxRecords"] or buffer["bytes"] + size > buffer["maxBytes"]):
+      flush(buffer)
+   record = {"Data": base64.b64encode(data).decode("ascii"), "PartitionKey": partitionKey}   # sent with b64_encode=False
+   if explicitHashKey is not None:
+      record["ExplicitHashKey"] = str(explicitHashKey)
+   buffer["records"].append(record)
+   buffer["bytes"] += size
+   if buffer["oldest"] is None:
+      buffer["oldest"] = time.monotonic()
+   if len(buffer["records"]) >= buffer["maxRecords"]:
+      flush(buffer)
+
+def lingerExpired(buffer):
+   return buffer["oldest"] is not None and time.monotonic() - buffer["oldest"] >= buffer["linger"]
+
+def backoffTime(attempt, base=0.05, cap=5):
+   # jittered exponential backoff ("full jitter")
+   return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def flush(buffer):
+   # sends the buffered records with PutRecords; after a partial failure only the failed entries are sent again
+   records = buffer["records"]
+   buffer["records"], buffer["bytes"], buffer["oldest"] = [], 0, None
+   if not records:
+      return
+   stats = buffer["stats"]
+   stats["batches"] += 1
+   for attempt in range(buffer["retries"] + 1):
+      if attempt > 0:
+         time.sleep(backoffTime(attempt - 1))
+         stats["resent"] += len(records)
+      stats["requests"] += 1
+      try:
+         response = buffer["conn"].put_records(records, buffer["stream"], b64_encode=False)
+      except ProvisionedThroughputExceededException:
+         continue   # the whole request was throttled
+      results = response["Records"]
+      failed = [record for record, result in zip(records, results) if "ErrorCode" in result]
+      stats["sent"] += len(records) - len(failed)
+      if not failed:
+         return
+      records = failed
+   stats["dropped"] += len(records)
+   print("dropped {} records after {} retries".format(len(records), buffer["retries"]))
+
+def anomalyRange(lowVal, highVal):
+   # anomalies lie far above the normal range: 100 to 120 for the normal range 10 to 20 of the demo sensor
+   width = max(highVal - lowVal, 1)
+   return highVal + 8 * width, highVal + 10 * width
+
+def nextReading(sensor="DemoSensor", lowVal=10, highVal=20, anomalyRate=ANOMALY_RATE):
    rnd = random.random()
-   if (rnd < 0.01):
-      data = json.dumps(getData("DemoSensor", 100, 120))  
-      kinesis.put_record("RawStreamData", data, "DemoSensor")
-      print '***************************** anomaly ************************* ' + data
+   if (rnd < anomalyRate):
+      return json.dumps(getData(sensor, *anomalyRange(lowVal, highVal))), True
+   return json.dumps(getData(sensor, lowVal, highVal)), False
+
+def readSensorRanges(fileName):
+   """
+   value range of every sensor of a csv file with the columns iotName and iotValue (like iot.csv of LogGenerator.zip);
+   a sensor with a single value varies by 10 % around it
+   output: list of (iotName, lowVal, highVal)
+   """
+   values = {}
+   with open(fileName, newline="", encoding="utf-8-sig") as f:
+      for row in csv.DictReader(f):
+         values.setdefault(row["iotName"].strip(), []).append(int(float(row["iotValue"])))
+   ranges = []
+   for name, vals in values.items():
+      lowVal, highVal = min(vals), max(vals)
+      if lowVal == highVal:
+         spread = max(abs(lowVal) // 10, 1)
+         lowVal, highVal = lowVal - spread, highVal + spread
+      ranges.append((name, lowVal, highVal))
+   return ranges
+
+def evenShards(count):
+   # hash key ranges of a stream whose shards split the hash key space evenly
+   return [("shardId-{:012d}".format(i), i * HASH_KEY_SPACE // count, (i + 1) * HASH_KEY_SPACE // count - 1) for i in range(count)]
+
+def streamShards(conn, streamName):
+   # hash key ranges of the open shards of the stream (closed shards after resharding have an EndingSequenceNumber)
+   shards = conn.describe_stream(streamName)["StreamDescription"]["Shards"]
+   return sorted((s["ShardId"], int(s["HashKeyRange"]["StartingHashKey"]), int(s["HashKeyRange"]["EndingHashKey"]))
+                 for s in shards if "EndingSequenceNumber" not in s["SequenceNumberRange"])
+
+def shardOf(shards, hashKey):
+   return shards[bisect.bisect_right([start for _, start, _ in shards], hashKey) - 1][0]
+
+def newFleet(count, shards, sensorRanges=None, spread="hash"):
+   """
+   count sensors, named after the sensors of sensorRanges (see readSensorRanges) with their value ranges, or
+   sensor-00000, ... with the range of the demo sensor
+   spread="hash": sensor i gets an explicit hash key in shard i % len(shards), so that every shard gets the same number of
+   sensors; spread="key": the partition key (the sensor name) decides the shard, as in Kinesis without explicit hash keys
+   """
+   templates = sensorRanges or [("sensor", 10, 20)]
+   perShard = -(-count // len(shards))
+   sensors = []
+   for i in range(count):
+      template, lowVal, highVal = templates[i % len(templates)]
+      name = template if count <= len(templates) and sensorRanges else "{}-{:05d}".format(template, i)
+      sensor = {"name": name, "low": lowVal, "high": highVal, "partitionKey": name, "explicitHashKey": None}
+      if spread == "hash":
+         shardId, start, end = shards[i % len(shards)]
+         sensor["explicitHashKey"] = start + (end - start) * (2 * (i // len(shards)) + 1) // (2 * perShard)
+         sensor["shard"] = shardId
+      else:
+         sensor["shard"] = shardOf(shards, int(hashlib.md5(name.encode("utf-8")).hexdigest(), 16))
+      sensors.append(sensor)
+   load = dict((shardId, {"sensors": 0, "readings": 0, "bytes": 0}) for shardId, _, _ in shards)
+   for sensor in sensors:
+      load[sensor["shard"]]["sensors"] += 1
+   return {"sensors": sensors, "shards": shards, "next": 0, "load": load}
+
+def nextFleetReading(fleet, anomalyRate=ANOMALY_RATE):
+   # the sensors report in turn; output: (sensor, data, anomaly)
+   sensor = fleet["sensors"][fleet["next"]]
+   fleet["next"] = (fleet["next"] + 1) % len(fleet["sensors"])
+   data, anomaly = nextReading(sensor["name"], sensor["low"], sensor["high"], anomalyRate)
+   load = fleet["load"][sensor["shard"]]
+   load["readings"] += 1
+   load["bytes"] += len(data) + len(sensor["partitionKey"])
+   return sensor, data, anomaly
+
+def printShardLoad(fleet):
+   # readings per shard and the imbalance of the busiest shard against the mean
+   load = fleet["load"]
+   total = sum(l["readings"] for l in load.values()) or 1
+   print("{:<22} {:>8} {:>10} {:>7} {:>12}".format("shard", "sensors", "readings", "share", "bytes"))
+   for shardId, l in load.items():
+      print("{:<22} {sensors:>8} {readings:>10} {:>6.1f}% {bytes:>12}".format(shardId, 100.0 * l["readings"] / total, **l))
+   mean = total / len(load)
+   print("busiest shard: {:.2f} x the mean load".format(max(l["readings"] for l in load.values()) / mean))
+
+def runSingle(conn, streamName, pacer=None, reportEvery=10, anomalyRate=ANOMALY_RATE):
+   # one PutRecord call per reading; with a pacer (see loadProfile.py) at the rate of its profile
+   reported = time.monotonic()
+   while 1:
+      if pacer:
+         pace(pacer)
+      data, anomaly = nextReading(anomalyRate=anomalyRate)
+      conn.put_record(streamName, data, "DemoSensor")
+      if anomaly:
+         print('***************************** anomaly ************************* ' + data)
+      else:
+         print(data)
+      if pacer and time.monotonic() - reported >= reportEvery:
+         reported = time.monotonic()
+         print(paceReport(pacer))
+
+def newProducer(conn, streamName, maxRecords=MAX_BATCH_RECORDS, linger=0.1, aggregate=False, aggregateBytes=DEFAULT_MAX_BYTES):
+   # batch buffer and, with aggregate=True, one aggregate per shard that packs readings into one record
+   # (see recordAggregation.py; an aggregated record goes to the shard of its first reading)
+   return {"buffer": newBuffer(conn, streamName, maxRecords=maxRecords, linger=linger),
+           "aggregateBytes": aggregateBytes if aggregate else None, "aggregates": {}, "readings": 0}
+
+def sendReading(producer, data, partitionKey, explicitHashKey=None, shard=None):
+   producer["readings"] += 1
+   if producer["aggregateBytes"] is None:
+      addRecord(producer["buffer"], data, partitionKey, explicitHashKey)
+      return
+   if shard not in producer["aggregates"]:
+      producer["aggregates"][shard] = {"aggregate": newAggregate(producer["aggregateBytes"]), "started": None}
+   pending = producer["aggregates"][shard]
+   if not pending["aggregate"]["records"]:
+      pending["started"] = time.monotonic()
+   finished = addUserRecord(pending["aggregate"], data, partitionKey, explicitHashKey)
+   if finished is not None:
+      pending["started"] = time.monotonic()
+      addRecord(producer["buffer"], *finished)
+
+def lingerDeadline(producer):
+   # time.monotonic() at which the oldest reading waiting in an aggregate or the batch buffer has to be sent, None if none waits
+   buffer = producer["buffer"]
+   started = [pending["started"] for pending in producer["aggregates"].values() if pending["aggregate"]["records"]]
+   if buffer["oldest"] is not None:
+      started.append(buffer["oldest"])
+   return min(started) + buffer["linger"] if started else None
+
+def flushIfLingering(producer, force=False):
+   # readings wait at most linger seconds, in the aggregate and in the batch buffer together
+   buffer, lingered = producer["buffer"], False
+   for pending in producer["aggregates"].values():
+      if pending["aggregate"]["records"] and (force or time.monotonic() - pending["started"] >= buffer["linger"]):
+         addRecord(buffer, *flushAggregate(pending["aggregate"]))
+         lingered = True   # its readings have waited linger seconds already
+   if force or lingered or lingerExpired(buffer):
+      flush(buffer)
+
+def printReport(producer, started, fleet=None, pacer=None):
+   now, stats = time.monotonic(), producer["buffer"]["stats"]
+   print("{} readings, {:.0f} readings/s in {:.0f} records/s, {}".format(producer["readings"],
+      producer["readings"] / (now - started), stats["sent"] / (now - started), stats))
+   if pacer:
+      print(paceReport(pacer))
+   if fleet:
+      printShardLoad(fleet)
+
+def runBatched(conn, streamName, maxRecords, linger, aggregate=False, reportEvery=10, fleet=None, pacer=None, anomalyRate=ANOMALY_RATE):
+   # fleet (see newFleet): readings of its sensors in turn, with the load per shard in every report;
+   # otherwise readings of the demo sensor; pacer (see loadProfile.py): readings at the rate of its profile
+   producer = newProducer(conn, streamName, maxRecords, linger, aggregate)
+   started = reported = time.monotonic()
+   try:
+      while 1:
+         # the pacer wakes up for the linger deadline of the buffered readings, too
+         if pacer and not pace(pacer, 1, lingerDeadline(producer)):
+            flushIfLingering(producer)
+            continue
+         if fleet:
+            sensor, data, anomaly = nextFleetReading(fleet, anomalyRate)
+            sendReading(producer, data, sensor["partitionKey"], sensor["explicitHashKey"], sensor["shard"])
+         else:
+            data, anomaly = nextReading(anomalyRate=anomalyRate)
+            sendReading(producer, data, "DemoSensor")
+         if anomaly:
+            print('***************************** anomaly ************************* ' + data)
+         flushIfLingering(producer)
+         if time.monotonic() - reported >= reportEvery:
+            reported = time.monotonic()
+            printReport(producer, started, fleet, pacer)
+   finally:
+      flushIfLingering(producer, force=True)
+      if fleet:
+         printShardLoad(fleet)
+
+def newBatchSource(fleet=None, anomalyRate=ANOMALY_RATE, seed=None):
+   # NumPy batch generator (see sensorBatch.py) of the sensors of the fleet or of the demo sensor
+   try:
+      from sensorBatch import newBatchGenerator
+   except ImportError:
+      raise ImportError("--vectorized requires the package numpy")
+   sensors = fleet["sensors"] if fleet else [{"name": "DemoSensor", "low": 10, "high": 20, "partitionKey": "DemoSensor",
+                                              "explicitHashKey": None, "shard": None}]
+   anomalyRanges = [anomalyRange(s["low"], s["high"]) for s in sensors]
+   gen = newBatchGenerator([s["name"] for s in sensors], [s["low"] for s in sensors], [s["high"] for s in sensors],
+                           [a[0] for a in anomalyRanges], [a[1] for a in anomalyRanges], anomalyRate, seed)
+   shardIds = list(fleet["load"]) if fleet else [None]
+   return {"gen": gen, "sensors": sensors, "shardIds": shardIds,
+           "shardIndex": [shardIds.index(s["shard"]) for s in sensors]}
+
+def runVectorized(conn, streamName, maxRecords, linger, aggregate=False, reportEvery=10, fleet=None, pacer=None,
+                  anomalyRate=ANOMALY_RATE, batchSize=1000, timestamps=False, seed=None):
+   # as runBatched, but the readings are generated and encoded batchSize at a time (with a pacer: as many as are due)
+   from sensorBatch import generateBatch, encodeBatch
+   import numpy as np
+   source = newBatchSource(fleet, anomalyRate, seed)
+   sensors, shardIndex = source["sensors"], np.array(source["shardIndex"])
+   keyBytes = np.array([len(s["partitionKey"].encode("utf-8")) for s in sensors])
+   producer = newProducer(conn, streamName, maxRecords, linger, aggregate)
+   started = reported = time.monotonic()
+   try:
+      while 1:
+         n = pace(pacer, batchSize, lingerDeadline(producer)) if pacer else batchSize
+         if not n:
+            flushIfLingering(producer)
+            continue
+         batch = generateBatch(source["gen"], n)
+         records = encodeBatch(source["gen"], batch, timestamps)
+         for s, data in zip(batch["sensor"].tolist(), records):
+            sensor = sensors[s]
+            sendReading(producer, data, sensor["partitionKey"], sensor["explicitHashKey"], sensor["shard"])
+         for i in np.flatnonzero(batch["anomaly"]).tolist():
+            print('***************************** anomaly ************************* ' + records[i].decode("utf-8"))
+         if fleet:
+            shards = shardIndex[batch["sensor"]]
+            readings = np.bincount(shards, minlength=len(source["shardIds"]))
+            sizes = np.bincount(shards, np.fromiter(map(len, records), np.int64, n) + keyBytes[batch["sensor"]], len(source["shardIds"]))
+            for shardId, r, b in zip(source["shardIds"], readings.tolist(), sizes.tolist()):
+               fleet["load"][shardId]["readings"] += r
+               fleet["load"][shardId]["bytes"] += int(b)
+         flushIfLingering(producer)
+         if time.monotonic() - reported >= reportEvery:
+            reported = time.monotonic()
+            printReport(producer, started, fleet, pacer)
+   finally:
+      flushIfLingering(producer, force=True)
+      if fleet:
+         printShardLoad(fleet)
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Sends simulated sensor readings to a Kinesis stream")
+   parser.add_argument("--stream", default="RawStreamData")
+   parser.add_argument("--region", default="us-east-1")
+   parser.add_argument("--batch", action="store_true", help="buffer readings and send them with PutRecords")
+   parser.add_argument("--batch-size", type=int, default=MAX_BATCH_RECORDS, help="records per PutRecords call (at most 500)")
+   parser.add_argument("--linger", type=float, default=0.1, help="seconds a reading may wait in the buffer")
+   parser.add_argument("--aggregate", action="store_true", help="pack many readings into one record (KPL format, implies --batch)")
+   parser.add_argument("--fleet", type=int, default=0, help="number of simulated sensors (implies --batch)")
+   parser.add_argument("--sensors-csv", help="csv file with iotName and iotValue columns (like iot.csv) the sensor ranges are taken from")
+   parser.add_argument("--shards", type=int, help="shards the stream is split into evenly (default: the shards of the stream)")
+   parser.add_argument("--spread", choices=["hash", "key"], default="hash",
+                       help="spread sensors over the shards with explicit hash keys or only by their partition keys")
+   parser.add_argument("--rate", type=float, help="target readings per second (default: as fast as possible)")
+   parser.add_argument("--profile", choices=PROFILES, default="constant", help="how the target rate changes over time")
+   parser.add_argument("--period", type=float, default=60, help="seconds of the ramp, of each step or of one sine cycle")
+   parser.add_argument("--start-rate", type=float, default=0, help="rate the ramp starts at")
+   parser.add_argument("--steps", help="comma separated rates of the step profile")
+   parser.add_argument("--amplitude", type=float, default=0.5, help="relative amplitude of the sine profile")
+   parser.add_argument("--burst-every", type=float, default=60, help="mean seconds between bursts of the poisson profile")
+   parser.add_argument("--burst-seconds", type=float, default=5, help="length of a burst")
+   parser.add_argument("--burst-factor", type=float, default=5, help="rate of a burst as a multiple of --rate")
+   parser.add_argument("--anomaly-rate", type=float, default=ANOMALY_RATE, help="share of anomalous readings")
+   parser.add_argument("--vectorized", action="store_true", help="generate the readings in batches with NumPy (implies --batch)")
+   parser.add_argument("--vector-size", type=int, default=1000, help="readings generated at once with --vectorized")
+   parser.add_argument("--timestamps", action="store_true", help="add the field timestamp to the readings (with --vectorized)")
+   parser.add_argument("--seed", type=int, help="seed of the readings and the profile, for repeatable runs")
+   args = parser.parse_args()
+
+   if args.seed is not None:
+      random.seed(args.seed)
+   pacer = None
+   if args.rate or args.steps:
+      pacer = newPacer(newProfile(args.profile, args.rate or 0, args.start_rate, args.period,
+                                  [float(r) for r in args.steps.split(",")] if args.steps else None, args.amplitude,
+                                  args.burst_every, args.burst_seconds, args.burst_factor, args.seed))
+
+   kinesis = kinesis.connect_to_region(args.region)
+
+   fleet = None
+   if args.fleet or args.sensors_csv:
+      sensorRanges = readSensorRanges(args.sensors_csv) if args.sensors_csv else None
+      shards = evenShards(args.shards) if args.shards else streamShards(kinesis, args.stream)
+      fleet = newFleet(args.fleet or len(sensorRanges), shards, sensorRanges, args.spread)
+
+   if args.vectorized:
+      runVectorized(kinesis, args.stream, args.batch_size, args.linger, args.aggregate, fleet=fleet, pacer=pacer,
+                    anomalyRate=args.anomaly_rate, batchSize=args.vector_size, timestamps=args.timestamps, seed=args.seed)
+   elif args.batch or args.aggregate or fleet:
+      runBatched(kinesis, args.stream, args.batch_size, args.linger, args.aggregate, fleet=fleet, pacer=pacer,
+                 anomalyRate=args.anomaly_rate)
    else:
-      data = json.dumps(getData("DemoSensor", 10, 20))  
-      kinesis.put_record("RawStreamData", data, "DemoSensor")
-      print data
+      runSingle(kinesis, args.stream, pacer, anomalyRate=args.anomaly_rate)
@@ -8,33 +8,654 @@ import pandas as pd
 import numpy as np
 import json
 import requests
+from requests.adapters import HTTPAdapter
+import io
+import codecs
+import csv
+import gzip
+import bz2
+import lzma
+import shutil
+import collections
+import bisect
+import random
+import re
+import hashlib
+import sqlite3
+import os
 import itertools
 from pathlib import Path
 from time import sleep
 import datetime
+import time
+import threading
+import queue
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 
 base_url = 'https://comtrade.un.org/api/get?'
 
-def mk_slice_points(reporter,partner,period,human_readable=False,product='all',frequency='A'):
+# limits of the API: number of codes per parameter in one call and number of rows in one response
+api_limits = {'reporter': 5, 'partner': 5, 'period': 5, 'product': 20, 'max': 100000}
+
+# rough number of codes behind special values, used to estimate the number of rows returned by an API call
+# (every other code counts as 1)
+code_weights = {
+    'reporter': {'all': 250},
+    'partner': {'all': 250},
+    'period': {'all': 30, 'recent': 5, 'now': 1}, # in years, times 12 for monthly data
+    'product': {'all': 6750, 'total': 1, 'ag2': 100, 'ag4': 1250, 'ag6': 5400, 'hg2': 100, 'hg4': 1250, 'hg6': 5400},
+}
+
+# column holding the codes of a parameter in the machine readable ('M') and human readable ('H') output
+result_columns = {
+    'reporter': ('rtCode', 'Reporter Code'),
+    'partner': ('ptCode', 'Partner Code'),
+    'period': ('period', 'Period'),
+    'product': ('cmdCode', 'Commodity Code'),
+    'tradeflow': ('rgCode', 'Trade Flow Code'),
+}
+
+# types of the fields of the machine readable ('M') output: categories for codes and descriptions,
+# the narrowest (nullable) integer types for numeric codes; fields not listed here keep the type pandas infers
+comtrade_schema = {
+    'pfCode': 'category', 'yr': 'Int16', 'period': 'Int32', 'periodDesc': 'category',
+    'aggrLevel': 'Int8', 'IsLeaf': 'Int8', 'rgCode': 'Int8', 'rgDesc': 'category',
+    'rtCode': 'Int16', 'rtTitle': 'category', 'rt3ISO': 'category',
+    'ptCode': 'Int16', 'ptTitle': 'category', 'pt3ISO': 'category',
+    'ptCode2': 'Int16', 'ptTitle2': 'category', 'pt3ISO2': 'category',
+    'cstCode': 'category', 'cstDesc': 'category', 'motCode': 'category', 'motDesc': 'category',
+    'cmdCode': 'category', 'cmdDescE': 'category',
+    'qtCode': 'Int8', 'qtDesc': 'category', 'qtAltCode': 'Int8', 'qtAltDesc': 'category',
+    'TradeQuantity': 'float64', 'AltQuantity': 'float64', 'NetWeight': 'float64', 'GrossWeight': 'float64',
+    'TradeValue': 'Int64', 'CIFValue': 'float64', 'FOBValue': 'float64', 'estCode': 'Int8',
+}
+
+# columns by which columnar datasets are partitioned (see save_columnar)
+partition_dims = ['reporter', 'partner', 'tradeflow', 'period']
+
+
+def apply_schema(df, schema=None):
+    """
+    converts the columns of a dataframe with machine readable headings to the types of 'schema' (default: comtrade_schema)
+    columns that are not in the schema or whose values do not fit the declared type are kept as they are
+    """
+    schema = comtrade_schema if schema is None else schema
+    for column in df.columns:
+        if column in schema:
+            try:
+                df[column] = df[column].astype(schema[column])
+            except (ValueError, TypeError):
+                pass
+    return df
+
+
+def concat_frames(dfs, **kwargs):
+    """
+    like pd.concat, but categorical columns stay categorical (pd.concat falls back to object if the categories differ)
+    """
+    dfs = list(dfs)
+    for column in set(col for df in dfs for col in df.columns):
+        parts = [df[column] for df in dfs if column in df.columns]
+        if len(parts) > 1 and all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            categories = pd.api.types.union_categoricals(parts, ignore_order=True).categories
+            dfs = [df.assign(**{column: df[column].cat.set_categories(categories)}) if column in df.columns else df
+                for df in dfs]
+    return pd.concat(dfs, **kwargs)
+
+
+def save_columnar(df, root, output_format='parquet', human_readable=False, compression='zstd', basename='part'):
+    """
+    adds the records of df to a columnar dataset in the directory 'root', partitioned by reporter, partner, trade flow and period
+    (one sub-directory per value, e.g. root/rtCode=682/ptCode=660/rgCode=1/period=201607/basename-0.parquet)
+    output_format: 'parquet' or 'arrow' (Arrow IPC files)
+    A file root/_schema.json records the columns and their types of all records written so far.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as pads
+    except ImportError:
+        raise ImportError("output_format='{}' requires the package pyarrow".format(output_format))
+
+    file_format = {'parquet': pads.ParquetFileFormat(), 'arrow': pads.IpcFileFormat()}[output_format]
+    partition_cols = [result_columns[dim][1 if human_readable else 0] for dim in partition_dims]
+    partition_cols = [col for col in partition_cols if col in df.columns]
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # partition columns are read back from the directory names, so their pandas types must not be restored
+    pandas_metadata = table.schema.pandas_metadata
+    pandas_metadata['columns'] = [col for col in pandas_metadata['columns'] if col['name'] not in partition_cols]
+    table = table.replace_schema_metadata({b'pandas': json.dumps(pandas_metadata).encode('utf-8')})
+    # categories get the same index width in every file, whatever their number, so that the files can be read together
+    table = table.cast(pa.schema([pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type))
+        if pa.types.is_dictionary(field.type) else field for field in table.schema], metadata=table.schema.metadata))
+    pads.write_dataset(table, root, format=file_format,
+        file_options=file_format.make_write_options(compression=compression),
+        partitioning=partition_cols, partitioning_flavor='hive',
+        basename_template=basename + '-{i}.' + output_format,
+        existing_data_behavior='overwrite_or_ignore')
+
+    update_schema_file(root, {'format': output_format, 'partitioning': partition_cols,
+        'fields': {field.name: str(field.type) for field in table.schema}})
+
+
+def update_schema_file(root, schema):
+    """
+    merges the fields of 'schema' into the sidecar file root/_schema.json of a columnar dataset
+    (a field keeps its first known type, unless that type was 'null', i.e. no values had been seen)
+    """
+    schema_file = os.path.join(root, '_schema.json')
+    try:
+        with open(schema_file) as f:
+            old_schema = json.load(f)
+    except (IOError, ValueError):
+        old_schema = dict(schema, fields={})
+    for name, type_name in schema['fields'].items():
+        if old_schema['fields'].get(name, 'null') == 'null':
+            old_schema['fields'][name] = type_name
+    with open(schema_file + '.tmp', 'w') as f:
+        json.dump(old_schema, f, indent=1)
+    os.replace(schema_file + '.tmp', schema_file)
+
+
+def product_tag(product):
+    """
+    output: the product parameter of a job as the start of the names of its files in a columnar dataset
+    (e.g. 'total' or '01,02'; see mk_sink and file_product)
+    """
+    codes = product if isinstance(product, list) else [product]
+    tag = re.sub('[^a-z0-9,]', '_', ','.join(str(code).lower() for code in codes))
+    return tag if len(tag) <= 140 else 'h' + hashlib.sha1(tag.encode('utf-8')).hexdigest()[:16] # 20 codes of 6 digits fit
+
+
+def file_product(path):
+    """
+    output: the product tag (see product_tag) of a data file of a columnar dataset, None for files written without one
+    """
+    name = os.path.basename(path)
+    return name.rsplit('-part', 1)[0] if '-part' in name else None
+
+
+def mk_sink(filename, output_format='csv', human_readable=False, product='total'):
+    """
+    creates a sink that writes the records of a job slice by slice instead of collecting them in memory
+    - output_format 'csv': csv file 'filename', compressed if it ends with '.gz', '.bz2' or '.xz'
+    - output_format 'parquet'/ 'arrow': columnar dataset in the directory 'filename' (see save_columnar); the names of the
+      files start with the product parameter of the job (see product_tag), since jobs with different products share partitions
+    Everything is written to a temporary file/ directory first and only moved into place by sink_close.
+    output: dictionary with the state of the sink (pass it to sink_write, sink_close or sink_abort)
+    """
+    sink = {'filename': filename, 'format': output_format, 'human_readable': human_readable, 'rows': 0, 'parts': 0,
+        'product': product_tag(product)}
+    if output_format == 'csv':
+        sink['tmp'] = '{}.{}.tmp'.format(filename, os.getpid())
+        sink['opener'] = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}.get(os.path.splitext(filename)[1], open)
+        sink['file'] = sink['opener'](sink['tmp'], 'wt', newline='')
+    else:
+        # hidden directory inside the dataset, ignored by readers of the dataset
+        sink['tmp'] = os.path.join(filename, '.staging-{}-{}'.format(os.getpid(), threading.get_ident()))
+        os.makedirs(sink['tmp'], exist_ok=True)
+    return sink
+
+
+def sink_write(sink, df):
+    """
+    appends the records of df to the sink
+    csv: the columns are put in the order of the first part; columns the first part did not have (the API may add fields)
+    are added to the file (see widen_csv_sink)
+    """
+    if sink['format'] == 'csv':
+        if sink['parts'] == 0:
+            sink['columns'] = list(df.columns)
+        else:
+            new_columns = [column for column in df.columns if column not in sink['columns']]
+            if new_columns:
+                widen_csv_sink(sink, new_columns)
+            df = df.reindex(columns=sink['columns'])
+        df.to_csv(sink['file'], header=sink['parts'] == 0)
+    else:
+        save_columnar(df, sink['tmp'], sink['format'], sink['human_readable'], basename='{}-part{}'.format(sink['product'], sink['parts']))
+    sink['parts'] += 1
+    sink['rows'] += len(df)
+
+
+def widen_csv_sink(sink, columns):
+    """
+    adds columns at the end of the csv file of a sink, empty in the records written so far
+    """
+    sink['file'].close()
+    tmp_path = sink['tmp'] + '.widen'
+    with sink['opener'](sink['tmp'], 'rt', newline='') as src, sink['opener'](tmp_path, 'wt', newline='') as dst:
+        reader, writer = csv.reader(src), csv.writer(dst, lineterminator=os.linesep) # as written by DataFrame.to_csv
+        writer.writerow(next(reader) + columns)
+        for row in reader:
+            writer.writerow(row + [''] * len(columns))
+    os.replace(tmp_path, sink['tmp'])
+    sink['file'] = sink['opener'](sink['tmp'], 'at', newline='')
+    sink['columns'] += columns
+
+
+def sink_close(sink):
+    """
+    moves the output of the sink into place; a file written by an earlier download of the same records is replaced (in a
+    columnar dataset: the files of the partitions written that have the same product, those of other products are kept)
+    nothing is written if the sink did not receive any records
+    output: number of records written
+    """
+    if sink['format'] == 'csv':
+        sink['file'].close()
+        if sink['rows'] > 0:
+            os.replace(sink['tmp'], sink['filename'])
+        else:
+            os.remove(sink['tmp'])
+        return sink['rows']
+
+    for dirpath, dirnames, files in os.walk(sink['tmp']):
+        files = [f for f in files if f != '_schema.json']
+        if not files:
+            continue
+        target = os.path.join(sink['filename'], os.path.relpath(dirpath, sink['tmp']))
+        os.makedirs(target, exist_ok=True)
+        for old in os.listdir(target):
+            if old.endswith('.' + sink['format']) and file_product(old) == sink['product']:
+                os.remove(os.path.join(target, old))
+        for f in files:
+            os.replace(os.path.join(dirpath, f), os.path.join(target, f))
+    if sink['rows'] > 0:
+        with open(os.path.join(sink['tmp'], '_schema.json')) as f:
+            update_schema_file(sink['filename'], json.load(f))
+    shutil.rmtree(sink['tmp'])
+    return sink['rows']
+
+
+def sink_abort(sink):
+    """
+    discards everything written to the sink (the output of earlier downloads is left untouched)
+    """
+    if sink['format'] == 'csv':
+        sink['file'].close()
+        os.remove(sink['tmp'])
+    else:
+        shutil.rmtree(sink['tmp'], ignore_errors=True)
+
+
+def run_pipeline(items, fetch, parse, fetch_workers=2, parse_workers=2, queue_size=4, stats=None):
+    """
+    staged producer/ consumer pipeline: fetch (threads) -> queue -> parse (process pool) -> queue -> caller
+    - fetch(item) runs on fetch_workers threads, parse(result of fetch) on parse_workers processes (so that parsing large
+      responses is not held back by the GIL), the caller receives the results in the order of the items
+    - the queues hold at most queue_size results; a full queue blocks the stage before it (backpressure) and the number of
+      items between fetch and caller is bounded, so memory does not grow with the number of items
+    - if the process pool fails on an item (e.g. a worker died or could not import the module), the item is parsed again
+      in this process, so that it is not downloaded again; these items are counted as 'fallbacks' of the parse stage
+    stats: dictionary that receives per stage the number of items, the time spent working ('busy_s'), waiting for input
+    ('starved_s') and waiting for room downstream ('blocked_s'), and per queue its maximum and mean occupancy
+    output: generator of (item, result of parse or the exception raised by fetch or parse, stage that raised it: 'fetch',
+    'parse' or None)
+    """
+    items = list(items)
+    stats = {} if stats is None else stats
+    for stage in ['fetch', 'parse', 'write']:
+        stats[stage] = {'items': 0, 'busy_s': 0.0, 'starved_s': 0.0, 'blocked_s': 0.0}
+    stats['parse']['fallbacks'] = 0
+    for name in ['fetched', 'parsed']:
+        stats[name + '_queue'] = {'size': queue_size, 'max': 0, 'mean': 0.0, 'samples': 0}
+
+    todo = queue.Queue()
+    for i in range(len(items)):
+        todo.put(i)
+    queues = {'fetched': queue.Queue(queue_size), 'parsed': queue.Queue(queue_size)}
+    window = threading.Semaphore(2 * queue_size + fetch_workers + parse_workers)
+    stop = threading.Event()
+    lock = threading.Lock()
+
+    def count(stage, key, seconds):
+        with lock:
+            stats[stage][key] += seconds
+
+    def put(name, stage, entry):
+        # waits for room in the queue (time counted as 'blocked') and samples its occupancy
+        started = time.time()
+        while not stop.is_set():
+            try:
+                queues[name].put(entry, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        count(stage, 'blocked_s', time.time() - started)
+        with lock:
+            q = stats[name + '_queue']
+            occupancy = queues[name].qsize()
+            q['max'] = max(q['max'], occupancy)
+            q['mean'] += (occupancy - q['mean']) / (q['samples'] + 1)
+            q['samples'] += 1
+
+    def get(name, stage):
+        # waits for the next entry of the queue (time counted as 'starved')
+        started = time.time()
+        while not stop.is_set():
+            try:
+                entry = queues[name].get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        else:
+            entry = None
+        count(stage, 'starved_s', time.time() - started)
+        return entry
+
+    def fetcher():
+        while not stop.is_set():
+            started = time.time()
+            if not window.acquire(timeout=0.1):
+                count('fetch', 'blocked_s', time.time() - started)
+                continue
+            count('fetch', 'blocked_s', time.time() - started)
+            try:
+                i = todo.get_nowait()
+            except queue.Empty:
+                window.release()
+                return
+            started = time.time()
+            try:
+                result, failed = fetch(items[i]), None
+            except Exception as e:
+                result, failed = e, 'fetch'
+            count('fetch', 'busy_s', time.time() - started)
+            count('fetch', 'items', 1)
+            put('fetched', 'fetch', (i, result, failed))
+
+    def parser(executor):
+        while not stop.is_set():
+            entry = get('fetched', 'parse')
+            if entry is None:
+                return
+            i, result, failed = entry
+            started = time.time()
+            if failed is None:
+                try:
+                    result = executor.submit(parse, result).result()
+                except Exception as e:
+                    with lock:
+                        stats['parse']['fallbacks'] += 1
+                        first = stats['parse']['fallbacks'] == 1
+                    if first:
+                        print('Warning: parsing in the process pool failed ({!r}), parsing in this process instead.'.format(e))
+                    try:
+                        result = parse(result)
+                    except Exception as e:
+                        result, failed = e, 'parse'
+            count('parse', 'busy_s', time.time() - started)
+            count('parse', 'items', 1)
+            put('parsed', 'parse', (i, result, failed))
+
+    with ProcessPoolExecutor(max_workers=parse_workers) as executor:
+        fetchers = [threading.Thread(target=fetcher, daemon=True) for _ in range(fetch_workers)]
+        parsers = [threading.Thread(target=parser, args=(executor,), daemon=True) for _ in range(parse_workers)]
+        for thread in fetchers + parsers:
+            thread.start()
+
+        def close_fetched():
+            # one end marker per parser once all items have been fetched
+            for thread in fetchers:
+                thread.join()
+            for _ in parsers:
+                put('fetched', 'fetch', None)
+        threading.Thread(target=close_fetched, daemon=True).start()
+
+        try:
+            pending = {}
+            for i in range(len(items)):
+                while i not in pending:
+                    entry = get('parsed', 'write')
+                    pending[entry[0]] = entry[1:]
+                result, failed = pending.pop(i)
+                started = time.time()
+                yield items[i], result, failed
+                count('write', 'busy_s', time.time() - started)
+                count('write', 'items', 1)
+                window.release()
+        finally:
+            stop.set()
+            for thread in parsers:
+                thread.join()
+
+
+def print_pipeline_stats(stats):
+    """
+    prints the statistics of run_pipeline: a stage that is mostly 'blocked' waits for a slower stage after it,
+    a stage that is mostly 'starved' waits for a slower stage before it
+    """
+    for stage in ['fetch', 'parse', 'write']:
+        print('{:6s}: {items} items, busy {busy_s:.1f} s, starved {starved_s:.1f} s, blocked {blocked_s:.1f} s'.format(stage, **stats[stage]))
+    if stats['parse'].get('fallbacks'):
+        print('parse : {} items parsed in this process after the process pool failed'.format(stats['parse']['fallbacks']))
+    for name in ['fetched', 'parsed']:
+        print('{} queue: max {max} of {size}, mean {mean:.1f}'.format(name, **stats[name + '_queue']))
+
+
+def map_in_order(func, items, workers=1):
+    """
+    like map(func, items), but with workers > 1 up to 'workers' calls run at the same time on a thread pool
+    the results are handed out in the order of the items and only a few of them are held at any time
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def as_code_list(codes):
+    """
+    input: a single code/ special value or a list of those
+    output: list of codes (so that e.g. 'all' is not sliced character by character)
+    """
+    return list(codes) if isinstance(codes, (list, tuple)) else [codes]
+
+
+def code_weight(dim, code, frequency='A'):
+    """
+    output: estimated number of codes the API returns for the code 'code' of the parameter 'dim'
+    """
+    weight = code_weights[dim].get(str(code).lower(), 1)
+    if dim == 'period' and weight > 1 and frequency.lower() == 'm':
+        weight *= 12
+    return weight
+
+
+def split_evenly(codes, n_blocks):
+    """
+    splits the list 'codes' into n_blocks consecutive blocks whose sizes differ by at most 1
+    """
+    size, rest = divmod(len(codes), n_blocks)
+    blocks, start = [], 0
+    for b in range(n_blocks):
+        end = start + size + (1 if b < rest else 0)
+        blocks.append(codes[start:end])
+        start = end
+    return blocks
+
+
+def dimension_options(dim, codes, frequency='A'):
+    """
+    lists the ways the codes of one parameter can be spread over API calls
+    output: list of (number of calls, estimated codes per call, blocks of codes, codes to keep or None)
+    - explicit lists cut into 1, 2, ... blocks respecting the limit of the API
+    - one call with the special ALL value whose result is filtered afterwards
+    """
+    if any(str(c).lower() == 'all' for c in codes):
+        return [(1, code_weight(dim, 'all', frequency), [['all']], None)]
+
+    options = []
+    for n_blocks in sorted(set(-(-len(codes) // size) for size in range(1, min(len(codes), api_limits[dim]) + 1))):
+        blocks = split_evenly(codes, n_blocks)
+        weight = max(sum(code_weight(dim, c, frequency) for c in block) for block in blocks)
+        options.append((n_blocks, weight, blocks, None))
+    options.append((1, code_weight(dim, 'all', frequency), [['all']], codes))
+    return options
 
-    # (2) warn/ raise an error if appropriate
 
-    if sum('all' in inpt for inpt in [reporter, partner, period]) > 1:
+def plan_api_calls(reporter, partner, period, product='all', frequency='A', fill_rate=1.0, max_rows=None):
+    """
+    finds the smallest set of API calls covering all requested reporters, partners, periods and products
+    - every call respects the limits of the API (5 reporters/ partners/ periods, 20 products, only one ALL among reporter/ partner/ period)
+    - the estimated number of rows of every call (product of the codes per parameter times fill_rate) stays below max_rows
+    - a single call with ALL replaces several explicit calls if its result still fits; it is filtered afterwards
+    fill_rate: share of reporter/ partner/ period/ product cells expected to hold a record (1.0 = worst case)
+    output: list of dictionaries with the codes of every call ('reporter', 'partner', 'period', 'product'),
+    the estimated number of rows ('rows') and the codes to keep from wildcard calls ('keep')
+    """
+    max_rows = api_limits['max'] if max_rows is None else max_rows
+    dims = ['reporter', 'partner', 'period', 'product']
+    requested = dict(zip(dims, map(as_code_list, [reporter, partner, period, product])))
+
+    if sum(any(str(c).lower() == 'all' for c in requested[dim]) for dim in dims[:3]) > 1:
         raise ValueError("Only one of the parameters 'reporter', 'partner' and 'period' may use the special ALL value in a given API call.")
 
-    if any(len(inpt) > 5 for inpt in [reporter, partner, period]) and human_readable:
-        print("Using the option human_readable=True is not recommended in this case because several API calls are necessary.")
-        print("When using the human_readable=True option, messages from the API cannot be received!")
-        response = input("Press y if you want to continue anyways. ")
-        if response != 'y':
-            return None # exit function
+    best, fallback = None, None
+    for combination in itertools.product(*[dimension_options(dim, requested[dim], frequency) for dim in dims]):
+        if sum(option[2] == [['all']] for option in combination[:3]) > 1:
+            continue
+        n_calls = np.prod([option[0] for option in combination])
+        rows = np.prod([option[1] for option in combination]) * fill_rate
+        if rows <= max_rows and (best is None or (n_calls, rows) < best[0]):
+            best = ((n_calls, rows), combination)
+        if fallback is None or (rows, n_calls) < fallback[0]:
+            fallback = ((rows, n_calls), combination)
+
+    if best is None:
+        print("Warning: even the smallest possible API calls are expected to return more than {} rows.".format(max_rows))
+        best = fallback
+
+    combination = best[1]
+    keep = {dim: option[3] for dim, option in zip(dims, combination) if option[3] is not None}
+    plan = []
+    for blocks in itertools.product(*[option[2] for option in combination]):
+        call = dict(zip(dims, blocks))
+        call['rows'] = np.prod([sum(code_weight(dim, c, frequency) for c in call[dim]) for dim in dims]) * fill_rate
+        call['keep'] = keep
+        plan.append(call)
+    return plan
+
+
+def print_plan(plan, limiter=None):
+    """
+    prints the API calls of a plan (see plan_api_calls) and its estimated cost
+    """
+    for n, call in enumerate(plan):
+        print(" call {}: r={} p={} ps={} cc={} (~{:,.0f} rows{})".format(n + 1,
+            *[dict_item_to_string(dim, call[dim]).split('=')[1] for dim in ['reporter', 'partner', 'period', 'product']],
+            call['rows'], ', filtered afterwards' if call['keep'] else ''))
+    cost = 'Plan: {} API call(s), ~{:,.0f} rows'.format(len(plan), sum(call['rows'] for call in plan))
+    if limiter is not None:
+        cost += ', ~{:.0f} s at the current rate limits'.format(estimate_wait_time(limiter, len(plan)))
+    print(cost)
+
+
+def filter_result(df, keep, human_readable=False):
+    """
+    keeps only the rows of df whose codes were requested (for calls that used ALL instead of a list of codes)
+    keep: dictionary parameter -> requested codes (see plan_api_calls)
+    the categories of the codes and descriptions of the records left out are removed
+    """
+    for dim, codes in keep.items():
+        column = result_columns[dim][1 if human_readable else 0]
+        if dim == 'product':
+            df = df[product_mask(df[column], codes)]
+        else:
+            df = df[df[column].astype(str).str.upper().isin([str(c).upper() for c in codes])]
+    if keep:
+        categorical = [column for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+        df = df.assign(**{column: df[column].cat.remove_unused_categories() for column in categorical})
+    return df if len(df) > 0 else None
+
+
+def product_mask(codes, products):
+    """
+    output: boolean series, True for the commodity codes (series of cmdCode values) that the product parameters request:
+    the code itself (e.g. '0101' or 'TOTAL'), an aggregation level ('AG2', 'HG4', ... = every code of that number of digits)
+    or 'ALL' (every code)
+    """
+    codes = codes.astype(str).str.upper()
+    mask = pd.Series(False, index=codes.index)
+    for product in products:
+        product = str(product).upper()
+        level = re.fullmatch('[AH]G([1-6])', product)
+        if product == 'ALL':
+            mask[:] = True
+        elif level:
+            mask |= codes.str.isdigit() & (codes.str.len() == int(level.group(1)))
+        else:
+            mask |= codes == product
+    return mask
+
+
+# cache for lists of area codes downloaded from the API (see area_codes)
+area_code_lists = {}
+
+# split of the special product value ALL into aggregation levels that can be requested one by one
+product_levels = ['TOTAL', 'AG2', 'AG4', 'AG6']
+
+
+def area_codes(dim, session):
+    """
+    output: list of all reporter ('reporter') or partner ('partner') codes known to the API, without the special value ALL
+    """
+    if dim not in area_code_lists:
+        url = base_url.split('/api/')[0] + '/data/cache/{}Areas.json'.format(dim)
+        results = session.get(url, timeout=120).json()['results']
+        area_code_lists[dim] = [area['id'] for area in results if area['id'].lower() != 'all']
+    return area_code_lists[dim]
+
+
+def is_saturated(df, max_rows=None):
+    """
+    output: True if the result of an API call was cut at the maximum number of rows, i.e. the API has more records than it returned
+    (from the number of records in the 'validation' block; without it, i.e. for human readable output, a result of
+    max_rows rows counts as cut)
+    """
+    if 'count' in df.attrs:
+        return df.attrs['count'] > len(df)
+    max_rows = api_limits['max'] if max_rows is None else max_rows
+    return len(df) >= max_rows
+
+
+def split_call(kwargs, session):
+    """
+    splits the codes of one API call (keyword arguments of download_trade_data_base) into smaller calls
+    order: several periods are halved first, then products (ALL becomes one call per aggregation level), then partners and reporters
+    (ALL becomes the list of all area codes, cut into blocks the API accepts)
+    output: list of keyword arguments, one per call, or None if the call cannot be split any further
+    """
+    for dim in ['period', 'product', 'partner', 'reporter']:
+        codes = as_code_list(kwargs[dim])
+        if dim == 'product' and [str(c).lower() for c in codes] == ['all']:
+            blocks = [[level] for level in product_levels]
+        elif dim in ['partner', 'reporter'] and [str(c).lower() for c in codes] == ['all']:
+            codes = area_codes(dim, session)
+            blocks = split_evenly(codes, -(-len(codes) // api_limits[dim]))
+        elif len(codes) > 1:
+            blocks = split_evenly(codes, 2)
+        else:
+            continue
+        return [dict(kwargs, **{dim: block}) for block in blocks]
+    return None
 
-    slice_points = [range(0, len(inpt), 5) for inpt in [reporter, partner, period]] +         [range(0, len(product), 20)]  
-    
-    return slice_points
 
 def download_trade_data(filename, human_readable=False, verbose=True,
-    period='recent', frequency='A', reporter='USA', partner='all', product='total', tradeflow='exports'):
+    period='recent', frequency='A', reporter='USA', partner='all', product='total', tradeflow='exports',
+    limiter=None, workers=1, session=None, stream=False, chunk_size=10000, cache=None, ledger=None,
+    output_format='csv', retries=5, pipeline=False, parse_workers=2, queue_size=4):
 
     """
     Downloads records from the UN Comtrade database and saves them in a csv-file with the name "filename".
@@ -43,6 +664,26 @@ def download_trade_data(filename, human_readable=False, verbose=True,
     - human_readable = False (default): headings in output are not human-readable but error messages from the API are received and displayed
     - human_readable = True: headings in output are human-readable but we do not get messages from the API about potential problems (not recommended if several API calls are necessary)
     Additional option: verbose = False in order to suppress both messages from the API and messages like '100 records downloaded and saved in filename.csv' (True is default)
+    Additional option: limiter = rate limiter from mk_rate_limiter that every API call takes a token from (default: the module-level 'rate_limiter'),
+    or a pool of API tokens from mk_token_pool: every call goes out on a token with budget left (use workers = number of tokens)
+    Additional option: workers = number of API calls kept in flight at the same time (1 is default); all of them share the limiter
+    and the results are merged in the same order as with workers = 1
+    Additional option: session = pooled HTTP session from mk_session used for all API calls (default: the module-level 'http_session')
+    Additional option: stream = True in order to parse the JSON responses incrementally in blocks of chunk_size records (see download_trade_data_base)
+    Additional option: cache = response cache from mk_response_cache (default: the module-level 'response_cache'); slices found
+    in the cache are neither downloaded again nor counted against the rate limits
+    Additional option: ledger = job ledger from mk_job_ledger (default: the module-level 'job_ledger', None = no ledger) in which the
+    state, number of rows, bytes and timing of the job (key: see job_id) and of each of its API calls are recorded
+    Additional option: output_format = 'parquet' or 'arrow' in order to add the records to a compressed columnar dataset in the
+    directory "filename", partitioned by reporter, partner, trade flow and period (see save_columnar; 'csv' is default);
+    the records are written slice by slice (see mk_sink), a filename ending with '.gz', '.bz2' or '.xz' gives a compressed csv file
+    Additional option: retries = number of times a failed API call is repeated (5 is default, see download_with_retries); while
+    one slice waits for its retry the other workers go on
+    Additional option: pipeline = True in order to run the API calls through a staged pipeline (see run_pipeline): 'workers' threads
+    download the responses, parse_workers processes parse them and this thread writes them; the stages are connected by queues
+    holding at most queue_size responses, statistics of the stages are shown at the end (only for human_readable = False)
+    Latency, bytes, rows, parse time, limiter wait, retries and cache lookups of every API call and the duration of the job are
+    recorded in the module-level 'download_metrics' (see mk_metrics, serve_metrics and flush_metrics)
     Parameters:
     Using parameter values suggested in the API documentation should always work.
     For the parameters period, reporter, partner and tradeflow more intuitive options have been added.
@@ -65,50 +706,179 @@ def download_trade_data(filename, human_readable=False, verbose=True,
      New fields may be added to the CSV or JSON output formats without warning. Please write your code that accesses the API accordingly.
      """
     #no need to transfer since the id is passed not the namee
-    
+
+    if output_format == 'csv':
+        filename = filename if len(filename.split('.')) >= 2 else filename + '.csv' # add '.csv' if necessary
+        # (before the job is entered in the ledger, whose key it is)
+    # every option that changes the output, so that retry_failed_jobs downloads the job again in the same way
+    job_params = dict(filename=filename, human_readable=human_readable, period=period, frequency=frequency,
+        reporter=reporter, partner=partner, product=product, tradeflow=tradeflow, output_format=output_format,
+        stream=stream, chunk_size=chunk_size)
+    job = job_id(**job_params)
     reporter = reporter #transform_reporter(reporter)
     partner = partner #transform_partner(partner)
     period = transform_period(period, frequency)
     
-    slice_points = mk_slice_points(reporter,partner,period,human_readable)
-        
-    # (3) download data by doing one or several API calls
+    # (2) plan the API calls, since the parameters reporter, partner and period are limited to 5 inputs each,
+    # product is limited to 20 inputs and one response to 100 000 rows
 
+    plan = plan_api_calls(reporter, partner, period, product, frequency)
 
-    # since the parameters reporter, partner and period are limited to 5 inputs each and
-    # product is limited to 20 inputs
-    
-    tradeflow = transform_tradeflow(tradeflow)
-    
-    dfs = []
-    
-    slices = itertools.product(*slice_points)
-    r = 0 
-    for i, j, k, m in slices:
+    if len(plan) > 1 and human_readable:
+        print("Using the option human_readable=True is not recommended in this case because several API calls are necessary.")
+        print("When using the human_readable=True option, messages from the API cannot be received!")
+        response = input("Press y if you want to continue anyways. ")
+        if response != 'y':
+            return None # exit function
 
-        df = download_trade_data_base(human_readable=human_readable, verbose=verbose,
-            period=period[k:k+5], reporter=reporter[i:i+5],
-            partner=partner[j:j+5], product=product[m:m+20],
-            tradeflow=tradeflow, frequency=frequency,filename=filename )
-        r += 1
+    # (3) download data by doing one or several API calls
 
+    tradeflow = transform_tradeflow(tradeflow)
+    limiter = limiter if limiter is not None else rate_limiter
+    if verbose: print_plan(plan, limiter)
+    
+    slices = [dict(human_readable=human_readable, verbose=verbose,
+            period=call['period'], reporter=call['reporter'],
+            partner=call['partner'], product=call['product'],
+            tradeflow=tradeflow, frequency=frequency, filename=None, session=session, # only the sink writes the output, an empty slice must not truncate it
+            stream=stream, chunk_size=chunk_size, limiter=limiter, cache=cache)
+        for call in plan]
+    n_calls = [] # one entry per API call, including the calls needed to split saturated slices
+
+    ledger = ledger if ledger is not None else job_ledger
+    job_started = time.time()
+    if ledger is not None:
+        ledger_record(ledger, 'jobs', job, state='in-flight', params=json.dumps(job_params),
+            rows=None, bytes=None, started=job_started, finished=None, error=None)
+        for kwargs in slices:
+            ledger_record(ledger, 'slices', slice_id(job, kwargs), job=job, state='pending',
+                params=json.dumps(slice_params(kwargs)), rows=None, bytes=None, started=None, finished=None, error=None)
+
+    def record(kwargs, **fields):
+        if ledger is not None:
+            ledger_record(ledger, 'slices', slice_id(job, kwargs), job=job,
+                params=json.dumps(slice_params(kwargs)), **fields)
+
+    def download_call(kwargs, fetched=None):
+        # fetched: (result, stage that failed) of the pipeline for this call (see run_pipeline), None if the call has not been made yet
+        started = time.time()
+        record(kwargs, state='in-flight', started=started, finished=None, error=None)
+        try:
+            if fetched is None:
+                df = download_with_retries(kwargs, retries, verbose)
+            elif fetched[1] is None:
+                df = finish_payload(*fetched[0], verbose=verbose, filename=kwargs['filename'])
+            elif fetched[1] == 'fetch':
+                raise fetched[0] # retried by fetch_slice already
+            else:
+                df = download_malformed(kwargs, fetched[0])
+        except Exception as e:
+            record(kwargs, state='failed', finished=time.time(), error=redact_token(str(e)))
+            raise
+        n_calls.append(1)
+        if df is None:
+            record(kwargs, state='empty', rows=0, bytes=None, finished=time.time())
+            return df
+        n_bytes = df.attrs.get('bytes')
+        if not is_saturated(df):
+            record(kwargs, state='done', rows=len(df), bytes=n_bytes, finished=time.time())
+            return df
+
+        # the API returned only the first rows: split the slice and download the pieces instead
+        pieces = split_call(kwargs, session if session is not None else http_session)
+        if pieces is None:
+            print("Warning: the slice {} cannot be split any further, its result is truncated at {} rows.".format(
+                {key: kwargs[key] for key in ['reporter', 'partner', 'period', 'product']}, len(df)))
+            record(kwargs, state='truncated', rows=len(df), bytes=n_bytes, finished=time.time())
+            df.attrs['truncated'] = True
+            return df
+        if verbose: print('Result truncated at {} rows, splitting the slice into {} API calls.'.format(len(df), len(pieces)))
+        dfs = [df for df in map(download_call, pieces) if df is not None]
+        df = concat_frames(dfs, ignore_index=True) if dfs else None
         if df is not None:
-            dfs.append(df)
-
-        sleep(1) # wait 1 second because of API rate limit
-
-    # (4) save dataframe as csv file
-
-    if len(dfs) > 0:
-        df_all = pd.concat(dfs)
-        filename = filename if len(filename.split('.')) >= 2 else filename + '.csv' # add '.csv' if necessary
-        df_all.to_csv(filename)
-        if verbose: print('{} records downloaded and saved as {}.'.format(len(df_all), filename))
+            df.attrs['bytes'] = sum(piece.attrs.get('bytes') or 0 for piece in dfs)
+            df.attrs['truncated'] = any(piece.attrs.get('truncated') for piece in dfs)
+        if df is None:
+            record(kwargs, state='empty', rows=0, bytes=None, finished=time.time())
+        else:
+            record(kwargs, state='truncated' if df.attrs['truncated'] else 'done', rows=len(df),
+                bytes=df.attrs['bytes'], finished=time.time())
+        return df
+
+    def download_malformed(kwargs, e):
+        # the response could not be parsed, also not in this process: as download_trade_data_base does with a malformed
+        # response, remove it from the cache and count the parse as the first attempt of the call
+        call_cache = cache if cache is not None else response_cache
+        if call_cache is not None:
+            cache_discard(call_cache, cache_key(api_url(**slice_params(kwargs))))
+        kind, wait = classify_error(e)
+        if kind == 'fatal' or retries == 0:
+            raise e
+        count_metric(download_metrics, 'comtrade_retries_total', kind=kind)
+        if verbose: print('{} error ({}), downloading the slice again'.format(kind.capitalize(), redact_token(str(e))[:200]))
+        return download_with_retries(kwargs, retries - 1, verbose)
+
+    def download_slice(kwargs, fetched=None):
+        df = download_call(kwargs, fetched)
+        return filter_result(df, plan[0]['keep'], human_readable) if df is not None else None
+
+    def fetch_slice(kwargs):
+        url = api_url(**slice_params(kwargs))
+        if verbose: print(url)
+        return call_with_retries(lambda: b''.join(fetch_payload(url, session if session is not None else http_session,
+            limiter, cache if cache is not None else response_cache, False, verbose)), limiter, retries, verbose)
+
+    # (4) save the records of every slice as soon as it has been downloaded (csv file or columnar dataset),
+    # the output only replaces an older file once the whole job has been downloaded
+
+    sink = mk_sink(filename, output_format, human_readable, product)
+    n_rows, n_bytes, truncated = 0, 0, False
+
+    pipeline_stats = None
+    try:
+        # with several workers, calls are in flight while the previous slice is parsed;
+        # the results are written in the order of the slices whatever order they finish in
+        if pipeline and not human_readable:
+            pipeline_stats = {}
+            parse = functools.partial(parse_payload_bytes, human_readable=human_readable, chunk_size=chunk_size)
+            fetched = run_pipeline(slices, fetch_slice, parse, workers, parse_workers, queue_size, pipeline_stats)
+            results = (download_slice(kwargs, (result, failed)) for kwargs, result, failed in fetched)
+        else:
+            results = map_in_order(download_slice, slices, workers)
+        for df in results:
+            if df is not None:
+                sink_write(sink, df)
+                n_rows += len(df)
+                n_bytes += df.attrs.get('bytes') or 0
+                truncated = truncated or bool(df.attrs.get('truncated'))
+        sink_close(sink)
+    except Exception as e:
+        sink_abort(sink)
+        if ledger is not None:
+            ledger_record(ledger, 'jobs', job, state='failed', finished=time.time(), error=redact_token(str(e)))
+        count_metric(download_metrics, 'comtrade_jobs_total', state='failed')
+        observe_metric(download_metrics, 'comtrade_job_seconds', time.time() - job_started)
+        raise
+    finally:
+        if pipeline_stats:
+            count_metric(download_metrics, 'comtrade_parse_fallbacks_total', pipeline_stats['parse']['fallbacks'])
+
+    r = len(n_calls)
+
+    state = 'empty' if n_rows == 0 else 'truncated' if truncated else 'done'
+    if ledger is not None:
+        ledger_record(ledger, 'jobs', job, state=state, rows=n_rows, bytes=n_bytes, finished=time.time())
+    count_metric(download_metrics, 'comtrade_jobs_total', state=state)
+    observe_metric(download_metrics, 'comtrade_job_seconds', time.time() - job_started)
+
+    if verbose and n_rows > 0: print('{} records downloaded and saved as {}.'.format(n_rows, filename))
+    if verbose and pipeline_stats: print_pipeline_stats(pipeline_stats)
             
     return (r)
 
 def download_trade_data_base(human_readable=False, verbose=True,
-    period='recent', frequency='A', reporter=842, partner='all', product='total', tradeflow=2,filename=None):
+    period='recent', frequency='A', reporter=842, partner='all', product='total', tradeflow=2,filename=None,
+    session=None, stream=False, chunk_size=10000, limiter=None, cache=None):
 
     """
     Downloads records from the UN Comtrade database and returns pandas dataframe using one API call.
@@ -116,6 +886,14 @@ def download_trade_data_base(human_readable=False, verbose=True,
     - human_readable = False (default): headings in output are not human-readable but error messages from the API are received and displayed
     - human_readable = True: headings in output are human-readable but we do not get messages from the API about potential problems
     Additional option: verbose = False in order to suppress messages from the API (True is default)
+    Additional option: session = pooled HTTP session from mk_session (default: the module-level 'http_session'),
+    so that consecutive calls reuse the same keep-alive connection instead of a new TCP/TLS handshake each time
+    Additional option: stream = True in order to parse the JSON response while it is downloaded: the records of 'dataset' are
+    collected column by column in blocks of chunk_size records, so neither the whole response text nor a dictionary for every
+    record is kept in memory (only for human_readable = False)
+    Additional option: limiter = rate limiter from mk_rate_limiter the API call waits for (default: the module-level 'rate_limiter')
+    Additional option: cache = response cache from mk_response_cache (default: the module-level 'response_cache', None = no cache);
+    a response found in the cache is read from disk without waiting for the limiter
     Parameters of the API call:
     As documented in the API documentation.
     More intuitive options for the parameters period, reporter, partner and tradeflow are only available in the function 'download_trade_data'!
@@ -127,6 +905,31 @@ def download_trade_data_base(human_readable=False, verbose=True,
      - tradeflow  [rg]   : 1 (for imports) or 2 (for exports); see https://comtrade.un.org/data/cache/tradeRegimes.json for further options
     """
 
+    url = api_url(human_readable, period, frequency, reporter, partner, product, tradeflow)
+
+    if verbose: print(url)
+
+    session = session if session is not None else http_session
+    limiter = limiter if limiter is not None else rate_limiter
+    cache = cache if cache is not None else response_cache
+
+    body = fetch_payload(url, session, limiter, cache, stream, verbose)
+
+    try:
+        dataframe, validation, n_bytes = parse_payload(body, human_readable, stream, chunk_size)
+    except Exception:
+        if cache is not None:
+            cache_discard(cache, cache_key(url)) # a malformed response must not be read from the cache again
+        raise
+
+    return finish_payload(dataframe, validation, n_bytes, verbose, filename)
+
+
+def api_url(human_readable=False, period='recent', frequency='A', reporter=842, partner='all', product='total', tradeflow=2):
+    """
+    output: URL of the API call for the given parameters (see download_trade_data_base)
+    """
+
     fmt = 'csv' if human_readable else 'json'
     head = 'H' if human_readable else 'M'
 
@@ -140,35 +943,143 @@ def download_trade_data_base(human_readable=False, verbose=True,
         'px': 'HS',      # Harmonized System (as reported) as classification scheme
         'type': 'C',     # Commodities ('S' for Services)
         'fmt': fmt,      # format of the output
-        'max': 100000,    # maximum number of rows -> what happens if number of rows is bigger?
+        'max': api_limits['max'], # maximum number of rows, larger results are split by download_trade_data (see split_call)
                          # https://comtrade.un.org/data/dev/portal#subscription says it is 100 000
         'head': head     # human readable headings ('H') or machine readable headings ('M')
     }
 
-    url = base_url + dict_to_string(parameters)
+    return base_url + dict_to_string(parameters)
 
-    if verbose: print(url)
+
+def fetch_payload(url, session, limiter, cache=None, stream=False, verbose=True):
+    """
+    reads the response of an API call from the cache or, after waiting for the limiter, from the API
+    (a response from the API is added to the cache while it is read)
+    limiter: rate limiter (see mk_rate_limiter) or token pool (see mk_token_pool)
+    output: iterable of blocks (bytes) of the response body
+    """
+    key = cache_key(url)
+    body = cache_get(cache, key) if cache is not None else None
+    if cache is not None:
+        count_metric(download_metrics, 'comtrade_cache_lookups_total', result='miss' if body is None else 'hit')
+
+    if body is None:
+        if 'members' in limiter: # token pool: the token with budget first, it is not part of the cache key
+            member, waited = acquire_pool_token(limiter, verbose=verbose)
+            url += '&token=' + member['token']
+        else:
+            waited = acquire_token(limiter, verbose=verbose) # wait until the API rate limits allow another call
+        observe_metric(download_metrics, 'comtrade_limiter_wait_seconds', waited)
+        started = time.time()
+        try:
+            response = session.get(url, timeout=120, stream=stream)
+        except Exception:
+            count_metric(download_metrics, 'comtrade_requests_total', status='error')
+            raise
+        count_metric(download_metrics, 'comtrade_requests_total', status=response.status_code)
+        if response.status_code >= 400:
+            observe_metric(download_metrics, 'comtrade_request_seconds', time.time() - started)
+        response.raise_for_status() # e.g. 409 if a usage limit was hit, classified by classify_error
+        body = response.iter_content(chunk_size=2**16) if stream else [response.content]
+        body = measure_body(body, 'api', started)
+        if cache is not None and response.status_code == 200:
+            body = cache_put(cache, key, body)
+    else:
+        body = measure_body(body, 'cache')
+        if verbose:
+            print('(read from cache)')
+
+    return body
+
+
+def measure_body(blocks, source, started=None):
+    """
+    passes the blocks of a response body through and records its size and (if started is given) the time from sending
+    the request until its last block was read
+    """
+    n_bytes = 0
+    try:
+        for block in blocks:
+            n_bytes += len(block)
+            yield block
+    finally: # also when the reader stops early, e.g. the streaming parser after the end of the dataset
+        count_metric(download_metrics, 'comtrade_response_bytes_total', n_bytes, source=source)
+        if started is not None:
+            observe_metric(download_metrics, 'comtrade_request_seconds', time.time() - started)
+
+
+def parse_payload(body, human_readable=False, stream=False, chunk_size=10000):
+    """
+    turns the body of a response (iterable of blocks of bytes) into a dataframe
+    output: (dataframe or None if the dataset is empty, 'validation' block or None for csv, number of bytes read)
+    """
+    n_bytes = [0]
+    def count_bytes(blocks):
+        for block in blocks:
+            n_bytes[0] += len(block)
+            yield block
+    body = count_bytes(body)
+
+    validation = None
+    started = time.time()
 
     if human_readable:
 
-        dataframe = pd.read_csv(url)
+        dataframe = pd.read_csv(io.StringIO(b''.join(body).decode('utf-8')))
+
+    elif stream:
+        meta = {} # receives the 'validation' block while the records are parsed
+        chunks = codecs.iterdecode(body, 'utf-8')
+        frames = [apply_schema(frame) for frame in iter_dataset_frames(iter_json_records(chunks, meta), chunk_size)]
+        # the parser stops after the closing brace: read the body to its end, or the response is not added to the cache
+        collections.deque(body, maxlen=0)
+        validation = meta['validation']
+        dataframe = concat_frames(frames, ignore_index=True) if frames else None
 
     else:
+        json_dict = json.loads(b''.join(body))
+        validation = json_dict['validation']
+        dataframe = apply_schema(pd.DataFrame.from_dict(json_dict['dataset'])) if json_dict['dataset'] else None
+
+    if dataframe is not None:
+        # recorded by finish_payload, also when parsed in another process (with stream = True it includes reading the response)
+        dataframe.attrs['parse_seconds'] = time.time() - started
+    return dataframe, validation, n_bytes[0]
 
-        json_dict = requests.get(url,timeout=120).json()
 
-        n_records = json_dict['validation']['count']['value']
-        message = json_dict['validation']['message']
+def parse_payload_bytes(data, human_readable=False, chunk_size=10000):
+    """
+    parse_payload for a complete response body (bytes), e.g. in a worker process of the download pipeline
+    """
+    return parse_payload([data], human_readable, False, chunk_size)
 
-        if not json_dict['dataset']:
+
+def finish_payload(dataframe, validation, n_bytes, verbose=True, filename=None):
+    """
+    shows the message of the API and stores the number of records the API has ('count') and the number of bytes of the
+    response ('bytes') in the attributes of the dataframe; an empty dataset leaves an empty file "filename" (if given)
+    output: dataframe or None if the dataset is empty
+    """
+    if validation is not None:
+
+        n_records = validation['count']['value']
+        message = validation['message']
+
+        if dataframe is None:
             if verbose: print('Error: empty dataset \n Message: {}'.format(message))
-            dataframe = None
-            f = open(filename,"w+")
-            f.close()
+            if filename is not None:
+                f = open(filename,"w+")
+                f.close()
 
         else:
             if verbose and message: print('Message: {}'.format(message))
-            dataframe = pd.DataFrame.from_dict(json_dict['dataset'])
+            dataframe.attrs['count'] = n_records # number of records the API has, may exceed the rows returned
+
+    if dataframe is not None:
+        dataframe.attrs['bytes'] = n_bytes
+        count_metric(download_metrics, 'comtrade_rows_parsed_total', len(dataframe))
+        if 'parse_seconds' in dataframe.attrs:
+            observe_metric(download_metrics, 'comtrade_parse_seconds', dataframe.attrs['parse_seconds'])
 
     return dataframe
 
@@ -251,64 +1162,1649 @@ def dict_to_string(parameters):
     return '&'.join(dict_item_to_string(key, value) for key, value in parameters.items())
 
 
+def iter_json_records(chunks, meta, key='dataset'):
+    """
+    incremental parser for a JSON object like {"validation": {...}, "dataset": [{...}, {...}, ...]}
+    chunks: iterable of pieces of the JSON text (e.g. a decoded HTTP response read in blocks)
+    meta: dictionary that receives every other top-level item (e.g. 'validation')
+    output: generator yielding the records of the array 'key' one by one; only the record being parsed is kept as text
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf, pos, eof = '', 0, False
+
+    def fill():
+        # reads the next piece of text, drops what has been parsed already; returns False at the end of the text
+        nonlocal buf, pos, eof
+        piece = next(chunks, None)
+        if piece is None:
+            eof = True
+            return False
+        buf, pos = buf[pos:] + piece, 0
+        return True
+
+    def peek():
+        # skips whitespace and returns the next character ('' at the end of the text)
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or not fill():
+                return buf[pos:pos+1]
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError("Expecting '{}' at position {} of the JSON response".format(char, pos))
+        pos += 1
+
+    def value():
+        # decodes the next complete value; a number at the end of the buffer might still continue in the next piece
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if not fill():
+                    raise
+                continue
+            if end < len(buf) or eof or not fill():
+                pos = end
+                return obj
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        name = value()
+        expect(':')
+        if name == key and peek() == '[':
+            pos += 1
+            if peek() == ']':
+                pos += 1
+            else:
+                while True:
+                    yield value()
+                    if peek() == ',':
+                        pos += 1
+                    else:
+                        expect(']')
+                        break
+            meta[name] = None # the records have been handed out already
+        else:
+            meta[name] = value()
+        if peek() == ',':
+            pos += 1
+        else:
+            expect('}')
+            return
+
+
+def iter_dataset_frames(records, chunk_size=10000):
+    """
+    collects records (dictionaries) column by column and hands them out as dataframes of at most chunk_size rows
+    records: iterable of dictionaries, e.g. from iter_json_records; missing fields become None
+    output: generator of pandas dataframes
+    """
+    columns, n = {}, 0
+    for record in records:
+        for field, val in record.items():
+            if field not in columns:
+                columns[field] = [None] * n
+            columns[field].append(val)
+        n += 1
+        for col in columns.values():
+            if len(col) < n:
+                col.append(None)
+        if n >= chunk_size:
+            yield pd.DataFrame(columns)
+            columns, n = {}, 0
+    if n > 0:
+        yield pd.DataFrame(columns)
+
+
+def mk_session(pool_size=10):
+    """
+    creates a requests session with a pool of keep-alive connections
+    pool_size: maximum number of connections kept open per host (should be at least the number of workers)
+    output: requests.Session that asks for gzip-compressed responses
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'})
+    return session
+
+
+def session_stats(session):
+    """
+    input: session from mk_session
+    output: dictionary with the number of requests sent, connections opened and requests that reused an open connection
+    """
+    n_requests, n_connections = 0, 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            n_requests += pools[key].num_requests
+            n_connections += pools[key].num_connections
+    return {'requests': n_requests, 'connections': n_connections, 'reused': n_requests - n_connections}
+
+
+def mk_response_cache(directory, max_bytes=2 * 1024**3, ttl=None):
+    """
+    creates an on-disk cache for API responses: one gzip-compressed file per request, named after the hash of the request URL
+    max_bytes: maximum size of all cached files, the least recently used responses are deleted beyond it
+    ttl: number of seconds after which a cached response counts as outdated (None = never)
+    output: dictionary with the settings, the index of cached responses and hit/ miss statistics
+    """
+    os.makedirs(directory, exist_ok=True)
+    cache = {
+        'directory': directory,
+        'max_bytes': max_bytes,
+        'ttl': ttl,
+        'not_before': 0, # responses cached before this time count as outdated (see run_refresh)
+        'index': {}, # key -> {'created': ..., 'used': ..., 'size': ...}
+        'stats': {'hits': 0, 'misses': 0, 'evictions': 0},
+        'lock': threading.Lock(),
+    }
+    try:
+        with open(os.path.join(directory, 'index.json')) as f:
+            cache['index'] = json.load(f)
+    except (IOError, ValueError):
+        pass
+    return cache
+
+
+def cache_key(url):
+    """
+    output: hash of the request URL with its parameters in canonical order, so that the same request always gets the same key
+    """
+    base, _, query = url.partition('?')
+    parameters = sorted(item.lower() for item in query.split('&'))
+    return hashlib.sha256((base + '?' + '&'.join(parameters)).encode('utf-8')).hexdigest()
+
+
+def cache_path(cache, key):
+    return os.path.join(cache['directory'], key + '.gz')
+
+
+def cache_get(cache, key):
+    """
+    output: generator of the (decompressed) cached response in blocks or None if the response is not cached or outdated
+    """
+    with cache['lock']:
+        entry = cache['index'].get(key)
+        now = time.time()
+        outdated = entry is not None and cache['ttl'] is not None and now - entry['created'] > cache['ttl']
+        if outdated or (entry is not None and entry['created'] < cache['not_before']):
+            cache_remove(cache, key)
+            entry = None
+        if entry is None or not os.path.exists(cache_path(cache, key)):
+            cache['stats']['misses'] += 1
+            return None
+        cache['stats']['hits'] += 1
+        entry['used'] = now
+        save_cache_index(cache)
+
+    def read_blocks(path):
+        with gzip.open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**16), b''):
+                yield block
+
+    return read_blocks(cache_path(cache, key))
+
+
+def cache_put(cache, key, blocks):
+    """
+    passes the blocks of a response on while writing them to the cache; the response is only added to the cache
+    once the last block has been read (an interrupted download never ends up in the cache)
+    """
+    tmp_path = cache_path(cache, key) + '.{}.tmp'.format(threading.get_ident())
+    try:
+        with gzip.open(tmp_path, 'wb') as f:
+            for block in blocks:
+                f.write(block)
+                yield block
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, cache_path(cache, key))
+
+    with cache['lock']:
+        now = time.time()
+        cache['index'][key] = {'created': now, 'used': now, 'size': os.path.getsize(cache_path(cache, key))}
+        total = sum(entry['size'] for entry in cache['index'].values())
+        for old_key in sorted(cache['index'], key=lambda k: cache['index'][k]['used']):
+            if total <= cache['max_bytes']:
+                break
+            total -= cache['index'][old_key]['size']
+            cache_remove(cache, old_key)
+            cache['stats']['evictions'] += 1
+        save_cache_index(cache)
+
+
+def cache_discard(cache, key):
+    """
+    deletes a response from the cache, e.g. because it could not be parsed
+    """
+    with cache['lock']:
+        cache_remove(cache, key)
+        save_cache_index(cache)
+
+
+def cache_remove(cache, key):
+    """
+    deletes a response from the cache (the caller holds the lock)
+    """
+    cache['index'].pop(key, None)
+    try:
+        os.remove(cache_path(cache, key))
+    except OSError:
+        pass
+
+
+def save_cache_index(cache):
+    tmp_file = os.path.join(cache['directory'], 'index.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(cache['index'], f)
+    os.replace(tmp_file, os.path.join(cache['directory'], 'index.json'))
+
+
+def cache_stats(cache):
+    """
+    output: dictionary with hits, misses, evictions, hit ratio, number of cached responses and their size in bytes
+    """
+    with cache['lock']:
+        stats = dict(cache['stats'])
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['entries'] = len(cache['index'])
+        stats['bytes'] = sum(entry['size'] for entry in cache['index'].values())
+    return stats
+
+
+def classify_error(e):
+    """
+    sorts an exception raised by an API call into
+    - 'throttled': HTTP 409, a usage limit was hit; the second output is the number of seconds until requests may resume
+      (None if the response does not tell)
+    - 'transient': 5xx, timeouts, broken connections and malformed bodies (e.g. an HTML error page instead of JSON)
+    - 'fatal': everything else, e.g. other 4xx errors; repeating the call would not help
+    output: (kind, seconds to wait or None)
+    """
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+        if status == 409:
+            return 'throttled', parse_resume_time(e.response)
+        if status >= 500:
+            return 'transient', None
+        return 'fatal', None
+    if isinstance(e, (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError)):
+        return 'transient', None
+    if isinstance(e, (ValueError, KeyError)): # json.JSONDecodeError is a ValueError
+        return 'transient', None
+    return 'fatal', None
+
+
+def parse_resume_time(response):
+    """
+    reads when requests may resume from a 409 response: a Retry-After header, a date and time in the message
+    (e.g. 'requests may resume at 2018-12-06T18:55:00', read as UTC if no time zone is given) or 'in N seconds/ minutes'
+    output: number of seconds to wait (at least 1) or None if the response does not tell
+    """
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return max(int(retry_after), 1)
+
+    text = response.text
+    now = datetime.datetime.now(datetime.timezone.utc)
+    match = re.search(r'(\d{4}-\d{2}-\d{2}[T ]\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?)', text)
+    if match:
+        try:
+            resume = datetime.datetime.fromisoformat(match.group(1).replace('Z', '+00:00'))
+        except ValueError:
+            resume = None
+        if resume is not None:
+            if resume.tzinfo is None:
+                resume = resume.replace(tzinfo=datetime.timezone.utc)
+            return max((resume - now).total_seconds(), 1)
+
+    match = re.search(r'in (\d+) ?(second|sec|minute|min)', text, re.IGNORECASE)
+    if match:
+        return max(int(match.group(1)) * (60 if match.group(2).lower().startswith('min') else 1), 1)
+    return None
+
+
+def backoff_time(attempt, base=2, cap=300):
+    """
+    output: jittered exponential backoff ('full jitter') before retry number attempt (0, 1, 2, ...)
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def download_with_retries(kwargs, retries=5, verbose=True):
+    """
+    calls download_trade_data_base(**kwargs) and repeats the call if it fails with an error that may go away (see call_with_retries)
+    """
+    limiter = kwargs.get('limiter') or rate_limiter
+    return call_with_retries(lambda: download_trade_data_base(**kwargs), limiter, retries, verbose)
+
+
+def call_with_retries(func, limiter, retries=5, verbose=True):
+    """
+    calls func() and repeats the call if it fails with an error that may go away (see classify_error)
+    - 409: the limiter (of a token pool: the limiter of the token used) lets no call through until the time given by
+      the API (or until it has earned a token back), then the call is repeated
+    - other transient errors: the call is repeated after a jittered exponential backoff; only this call waits
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            kind, wait = classify_error(e)
+            if kind == 'fatal' or attempt == retries:
+                raise
+            count_metric(download_metrics, 'comtrade_retries_total', kind=kind)
+            if kind == 'transient':
+                wait = backoff_time(attempt)
+            if verbose:
+                print('{} error ({}), retry {} of {}{}'.format(kind.capitalize(), redact_token(str(e))[:200], attempt + 1, retries,
+                    ' in {:.1f} s'.format(wait) if wait is not None else ''))
+            if kind == 'throttled':
+                # with a token pool only the limiter of the throttled token, the other tokens go on
+                throttled = error_limiter(limiter, e)
+                if wait is not None:
+                    hold_tokens(throttled, wait)
+                else:
+                    drain_tokens(throttled)
+            else:
+                sleep(wait)
+
+
+def mk_job_ledger(path):
+    """
+    opens (or creates) a SQLite job ledger with one row per job (download_trade_data call, id: see job_id) and one row
+    per API call (slice) of a job
+    states: 'pending', 'in-flight', 'done', 'empty' (no records), 'truncated' (row cap hit and no further split possible), 'failed'
+    output: dictionary with the database connection
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    for table, extra in [('jobs', ''), ('slices', 'job TEXT, ')]:
+        conn.execute('CREATE TABLE IF NOT EXISTS {} (id TEXT PRIMARY KEY, {}state TEXT, params TEXT, rows INTEGER, '
+            'bytes INTEGER, started REAL, finished REAL, error TEXT)'.format(table, extra))
+    conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+    conn.execute('CREATE INDEX IF NOT EXISTS slices_job_state ON slices (job, state)')
+    return {'path': path, 'conn': conn, 'lock': threading.Lock()}
+
+
+def ledger_record(ledger, table, id, **fields):
+    """
+    inserts or updates (only the given fields of) the row 'id' of the table 'jobs' or 'slices' in one transaction
+    """
+    columns = ', '.join(fields)
+    updates = ', '.join('{0} = excluded.{0}'.format(column) for column in fields)
+    sql = 'INSERT INTO {} (id, {}) VALUES (?{}) ON CONFLICT (id) DO UPDATE SET {}'.format(
+        table, columns, ', ?' * len(fields), updates)
+    with ledger['lock']:
+        with ledger['conn']:
+            ledger['conn'].execute(sql, [id] + list(fields.values()))
+
+
+def ledger_job_states(ledger):
+    """
+    output: dictionary job (see job_id) -> state of all jobs in the ledger (one query, used to resume the driver)
+    """
+    with ledger['lock']:
+        return dict(ledger['conn'].execute('SELECT id, state FROM jobs'))
+
+
+def ledger_slices(ledger, states=('failed',), job=None):
+    """
+    output: list of dictionaries (id, job, state, params, rows, bytes, started, finished, error) of the slices in one of the given states
+    """
+    sql = 'SELECT id, job, state, params, rows, bytes, started, finished, error FROM slices WHERE state IN ({})'.format(
+        ', '.join('?' * len(states)))
+    args = list(states)
+    if job is not None:
+        sql += ' AND job = ?'
+        args.append(job)
+    with ledger['lock']:
+        rows = ledger['conn'].execute(sql, args).fetchall()
+    keys = ['id', 'job', 'state', 'params', 'rows', 'bytes', 'started', 'finished', 'error']
+    return [dict(zip(keys, row), params=json.loads(row[3])) for row in rows]
+
+
+def retry_failed_jobs(ledger, states=('failed', 'truncated'), **options):
+    """
+    downloads again every job of the ledger that has slices in one of the given states
+    slices that were downloaded before are read from the response cache, so only the failed slices cost API calls
+    options: further arguments of download_trade_data (e.g. workers, stream)
+    output: number of API calls
+    """
+    jobs = sorted(set(s['job'] for s in ledger_slices(ledger, states)))
+    with ledger['lock']:
+        params = dict((job, json.loads(p)) for job, p in ledger['conn'].execute('SELECT id, params FROM jobs'))
+    r = 0
+    for job in jobs:
+        print('Retrying {}...'.format(job))
+        r += download_trade_data(ledger=ledger, **dict(params[job], **options)) or 0
+    return r
+
+
+def job_id(filename, output_format='csv', **params):
+    """
+    output: key of a job (download_trade_data call with the given arguments) in the ledger: the csv file it writes or, since
+    all jobs of a columnar dataset write to the same directory, the directory and the parameters that define the records
+    """
+    if output_format == 'csv':
+        return filename if len(filename.split('.')) >= 2 else filename + '.csv' # as download_trade_data names the file
+    return filename + '|' + json.dumps({key: params.get(key, False if key == 'human_readable' else None)
+        for key in ['human_readable'] + spec_dims}, sort_keys=True)
+
+
+def slice_params(kwargs):
+    """
+    output: the parameters of an API call (keyword arguments of download_trade_data_base) that define its result
+    """
+    return {key: kwargs[key] for key in ['human_readable', 'period', 'frequency', 'reporter', 'partner', 'product', 'tradeflow']}
+
+
+def slice_id(job, kwargs):
+    return job + '|' + json.dumps(slice_params(kwargs), sort_keys=True)
+
+
+# names of the trade flow codes in the filenames of compiled jobs (see compile_job_spec), spelled as in the files of the
+# earlier driver loop ('import', 'Export')
+tradeflow_names = {1: 'import', 2: 'Export', 3: 're-export', 4: 're-import'}
+
+# parameters of download_trade_data that a job spec lists (every other key of a grid is passed on as an option)
+spec_dims = ['reporter', 'partner', 'tradeflow', 'period', 'product', 'frequency']
+
+# template of the filenames of compiled jobs if the spec does not give one (see compile_job_spec)
+default_output = '{partner}_{tradeflow}_{period}_{reporter}_{product}.csv'
+
+# templates of the names of the csv files of a store and the parameters the names leave out (see filename_params): files
+# of compiled jobs and files of the earlier driver loop, which always downloaded product 'all'
+store_outputs = [(default_output, {}), ('{partner}_{tradeflow}_{period}_{reporter}.csv', {'product': 'all'})]
+
+
+def load_job_spec(path):
+    """
+    reads a job spec from a json or (with the package pyyaml) yaml file, e.g.
+    {"output": "/var/log/cadabra/{partner}_{tradeflow}_{period}_{reporter}.csv", "frequency": "M", "product": "all",
+     "jobs": [{"reporter": ["682"], "partner": ["660"], "tradeflow": ["import", "export"], "period": ["201001-201005", "201006-201010"]}]}
+    every entry of "jobs" is a grid of cells (reporter x partner x tradeflow x period); keys missing in a grid are taken
+    from the top level, further keys (e.g. "workers") are passed on to download_trade_data
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("reading {} requires the package pyyaml".format(path))
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def period_index(period, frequency):
+    """
+    output: position of a period (YYYY or YYYYMM) on a time line of years or months, None for special values like 'recent'
+    """
+    period = str(period)
+    if not period.isdigit():
+        return None
+    if frequency.lower() == 'm':
+        return int(period[:4]) * 12 + int(period[4:6]) - 1
+    return int(period)
+
+
+def index_period(index, frequency):
+    """
+    inverse of period_index
+    """
+    if frequency.lower() == 'm':
+        year, month = divmod(index, 12)
+        return '{}{:02d}'.format(year, month + 1)
+    return str(index)
+
+
+def coalesce_periods(periods, frequency):
+    """
+    merges periods (YYYY/ YYYYMM, ranges like 'YYYYMM-YYYYMM' or lists of those) into the fewest ranges
+    example: ['201001-201005', '201006-201010', '201012'] => ['201001-201010', '201012']
+    output: list of ranges (single periods without '-'); special values like 'recent' are kept as they are
+    """
+    special = sorted(set(str(p) for p in transform_period(periods, frequency) if period_index(p, frequency) is None))
+    indices = sorted(set(period_index(p, frequency) for p in transform_period(periods, frequency)) - {None})
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ['-'.join(sorted(set([index_period(start, frequency), index_period(end, frequency)]))) for start, end in ranges] + special
+
+
+def expand_job_spec(spec):
+    """
+    output: dictionary with one entry per requested cell (frequency, product, tradeflow, reporter, partner, period),
+    whatever number of grids of the spec request it, -> options of download_trade_data of the first grid requesting it
+    """
+    cells = {}
+    for grid in spec.get('jobs', [{}]):
+        grid = dict({key: value for key, value in spec.items() if key not in ['jobs', 'output']}, **grid)
+        options = {key: value for key, value in grid.items() if key not in spec_dims}
+        frequency = grid.get('frequency', 'A').upper()
+        for product in as_code_list(grid.get('product', 'total')):
+            for tradeflow in as_code_list(grid.get('tradeflow', 'exports')):
+                tradeflow = transform_tradeflow(tradeflow)
+                for reporter in as_code_list(grid['reporter']):
+                    for partner in as_code_list(grid.get('partner', 'all')):
+                        for period in transform_period(grid.get('period', 'recent'), frequency):
+                            cell = (frequency, str(product), tradeflow, str(reporter), str(partner), str(period))
+                            cells.setdefault(cell, options)
+    return cells
+
+
+def call_cells(call, tradeflow):
+    """
+    output: list of the cells [reporter, partner, tradeflow, period] an API call of a plan covers
+    (for a call using ALL, the codes kept from its result)
+    """
+    dims = ['reporter', 'partner', 'period']
+    codes = [call['keep'].get(dim) or call[dim] for dim in dims]
+    return [[r, p, tradeflow, ps] for r, p, ps in itertools.product(*codes)]
+
+
+def compile_job_spec(spec, output=None, coverage=None):
+    """
+    compiles a job spec (see load_job_spec) into a deduplicated, merged list of jobs (download_trade_data calls)
+    - cells requested by several grids are downloaded once (with the options of the first grid requesting them)
+    - partners with the same periods and reporters with the same partners and periods are merged into one job,
+      so that plan_api_calls can put up to 5 of them in one API call, and so are up to 20 products with the same
+      reporters, partners and periods
+    - the periods of a job are coalesced into the fewest ranges (see coalesce_periods)
+    output: template of the filenames (default: spec['output'], else default_output), fields {reporter}, {partner}, {tradeflow},
+    {period}, {product} and {frequency}, several codes are joined by '+'; jobs writing csv files must get different names
+    (see run_compiled_jobs)
+    result: list of jobs, dictionaries with the arguments of download_trade_data (filename, reporter, partner, period, ...,
+    options) and the API calls the job will make ('calls', see plan_api_calls), each with the cells it covers ('cells')
+    coverage: coverage index (see mk_coverage_index); cells the store holds already are left out
+    """
+    output = output or spec.get('output', default_output)
+    cells = expand_job_spec(spec)
+    if coverage is not None:
+        n_cells = len(cells)
+        cells = {cell: options for cell, options in cells.items() if not is_covered(coverage, cell)}
+        print('{} of {} cells are in the store already'.format(n_cells - len(cells), n_cells))
+
+    # periods per reporter/ partner, then partners with the same periods, then reporters with the same partners and periods
+    periods = collections.defaultdict(set)
+    for (frequency, product, tradeflow, reporter, partner, period) in cells:
+        periods[(frequency, product, tradeflow), reporter, partner].add(period)
+    partners = collections.defaultdict(list)
+    for (key, reporter, partner), ps in periods.items():
+        partners[key, reporter, tuple(coalesce_periods(sorted(ps), key[0]))].append(partner)
+    reporters = collections.defaultdict(list)
+    for (key, reporter, ps), ps_partners in partners.items():
+        reporters[key, tuple(sorted(ps_partners)), ps].append(reporter)
+    products = collections.defaultdict(list)
+    for ((frequency, product, tradeflow), job_partners, job_periods), job_reporters in reporters.items():
+        products[frequency, tradeflow, job_partners, job_periods, tuple(sorted(job_reporters))].append(product)
+
+    jobs = []
+    for (frequency, tradeflow, job_partners, job_periods, job_reporters), job_products in sorted(products.items()):
+        # blocks of products the API takes in one call
+        for block in split_evenly(sorted(job_products), -(-len(job_products) // api_limits['product'])):
+            # options (e.g. workers) of the first grid that requested the first cell of the job
+            options = next(options for cell, options in cells.items() if cell[0] == frequency and cell[1] in block
+                and cell[2] == tradeflow and cell[3] in job_reporters and cell[4] in job_partners)
+            job = {'reporter': list(job_reporters), 'partner': list(job_partners), 'period': list(job_periods),
+                   'product': block if len(block) > 1 else block[0], 'frequency': frequency, 'tradeflow': tradeflow,
+                   'options': options, 'output': output}
+            jobs.append(plan_job(job))
+    return jobs
+
+
+def plan_job(job):
+    """
+    adds the filename (from the template job['output']) and the API calls with the cells they cover to a job
+    """
+    fields = {dim: '+'.join(map(str, as_code_list(job[dim]))) for dim in spec_dims}
+    fields['tradeflow'] = tradeflow_names.get(job['tradeflow'], str(job['tradeflow']))
+    job['filename'] = job['output'].format(**fields)
+    plan = plan_api_calls(job['reporter'], job['partner'], transform_period(job['period'], job['frequency']),
+        job['product'], job['frequency'])
+    job['calls'] = [dict(call, cells=call_cells(call, job['tradeflow'])) for call in plan]
+    return job
+
+
+def print_compiled_jobs(jobs, limiter=None):
+    """
+    prints the jobs of a compiled job spec and the total number of API calls and cells
+    """
+    for job in jobs:
+        print('{filename}: {n_calls} API call(s), {n_cells} cells'.format(filename=job['filename'], n_calls=len(job['calls']),
+            n_cells=sum(len(call['cells']) for call in job['calls'])))
+    n_calls = sum(len(job['calls']) for job in jobs)
+    cost = 'Job spec: {} job(s), {} API call(s), {} cells'.format(len(jobs), n_calls,
+        sum(len(call['cells']) for job in jobs for call in job['calls']))
+    if limiter is not None:
+        cost += ', ~{:.0f} s at the current rate limits'.format(estimate_wait_time(limiter, n_calls))
+    print(cost)
+
+
+def save_compiled_jobs(jobs, path):
+    """
+    writes the compiled jobs, with the cells covered by every API call, to a json file
+    """
+    def default(value): # numpy numbers of the row estimates
+        return value.item() if hasattr(value, 'item') else str(value)
+    with open(path, 'w') as f:
+        json.dump(jobs, f, indent=1, default=default)
+
+
+def run_compiled_jobs(jobs, ledger=None, skip=('done', 'empty'), coverage=None, **options):
+    """
+    runs download_trade_data for every compiled job that the ledger does not list in one of the states 'skip'
+    options: further arguments of download_trade_data for every job (the options of a job's grid take precedence)
+    coverage: coverage index (see mk_coverage_index) to which the cells of every job downloaded are added
+    output: number of API calls
+    raises ValueError before downloading anything if several jobs would write the same csv file (their records would
+    overwrite each other), e.g. jobs for different products with a filename template without {product}
+    """
+    ledger = ledger if ledger is not None else job_ledger
+    job_states = ledger_job_states(ledger) if ledger is not None else {}
+    files = collections.Counter(job_id(**dict({key: job[key] for key in ['filename'] + spec_dims}, **dict(options, **job['options'])))
+        for job in jobs if dict(options, **job['options']).get('output_format', 'csv') == 'csv')
+    shared = sorted(filename for filename, n in files.items() if n > 1)
+    if shared:
+        raise ValueError('several jobs would write to {} (add the fields that tell them apart, e.g. {{product}}, to the '
+            'filename template)'.format(', '.join(shared)))
+    limiter = options.get('limiter') or rate_limiter
+    r = 0
+    for i, job in enumerate(jobs):
+        arguments = dict({key: job[key] for key in ['filename'] + spec_dims}, **dict(options, **job['options']))
+        if job_states.get(job_id(**arguments)) in skip:
+            print("the file {} exists".format(job['filename']))
+            continue
+        n_calls = sum(len(later['calls']) for later in jobs[i:])
+        eta = datetime.datetime.now() + datetime.timedelta(seconds=estimate_wait_time(limiter, n_calls))
+        print('Requesting data for {} ({} of {}, {} API calls left, done at ~{:%d/%m/%Y %H:%M})...'.format(
+            job['filename'], i + 1, len(jobs), n_calls, eta))
+        try:
+            reqs = download_trade_data(ledger=ledger, **arguments)
+        except Exception as e:
+            print(redact_token(str(e)))
+            print("There was a problem downloading the data") # retried already, see download_with_retries
+        else:
+            r += reqs if reqs > 0 else 1
+            if coverage is not None:
+                for call in job['calls']:
+                    for reporter, partner, tradeflow, period in call['cells']:
+                        for product in as_code_list(job['product']):
+                            add_coverage(coverage, (job['frequency'], product, tradeflow, reporter, partner), period, period)
+            print("{} requests this session".format(r))
+            print("{reused} of {requests} requests reused an open connection".format(**session_stats(http_session)))
+            if response_cache is not None:
+                print("cache: {hits} hits, {misses} misses ({hit_ratio:.0%})".format(**cache_stats(response_cache)))
+        flush_metrics(download_metrics)
+    return r
+
+
+def split_jobs(jobs):
+    """
+    output: list of jobs with one API call each (one per call of the given jobs), so that calls can be scheduled one by one;
+    every job downloads the codes its call was planned for (for calls using ALL: the codes kept from the result)
+    """
+    units = []
+    for job in jobs:
+        if len(job['calls']) == 1:
+            units.append(job)
+            continue
+        for call in job['calls']:
+            unit = dict(job, **{dim: call['keep'].get(dim) or call[dim] for dim in ['reporter', 'partner']})
+            unit['period'] = coalesce_periods(call['keep'].get('period') or call['period'], job['frequency'])
+            product = call['keep'].get('product') or call['product']
+            unit['product'] = product if len(product) > 1 else product[0]
+            units.append(plan_job(unit))
+    return units
+
+
+def call_priority(call, frequency, sla_reporters=(), sla_boost=10, half_life=1.0, today=None):
+    """
+    output: value of an API call = expected useful rows (estimated rows times the share of them kept, for calls using ALL)
+    weighted by priority: halved for every half_life years its latest period lies back, times sla_boost if it downloads
+    one of the sla_reporters
+    """
+    share = np.prod([len(codes) / code_weight(dim, 'all', frequency) for dim, codes in call['keep'].items()] or [1])
+    rows = call['rows'] * min(share, 1)
+    latest = [period_index(cell[3], frequency) for cell in call['cells'] if period_index(cell[3], frequency) is not None]
+    weight = 1.0
+    if latest:
+        age = period_index(last_complete_period(frequency, today), frequency) - max(latest)
+        weight *= 0.5 ** (max(age, 0) / (12.0 if frequency.lower() == 'm' else 1.0) / half_life)
+    if any(str(reporter) in map(str, sla_reporters) for reporter in set(cell[0] for cell in call['cells'])):
+        weight *= sla_boost
+    return rows * weight
+
+
+def hourly_budget(limiter):
+    """
+    output: (API calls the limiter (or token pool) allows right now, API calls it allows per hour)
+    """
+    limiters = [member['limiter'] for member in limiter['members']] if 'members' in limiter else [limiter]
+    now_left, per_hour = 0, 0
+    for l in limiters:
+        with l['lock']:
+            refill_buckets(l)
+            if l['hold_until'] <= l['updated']:
+                now_left += int(max(l['buckets']['hour']['tokens'], 0))
+            per_hour += l['buckets']['hour']['capacity']
+    return now_left, per_hour
+
+
+def schedule_jobs(jobs, limiter=None, sla_reporters=(), sla_boost=10, half_life=1.0):
+    """
+    orders the API calls of compiled jobs (see compile_job_spec) so that every hourly budget of the limiter is filled with
+    the calls of the highest value (see call_priority): recent periods and SLA reporters first, among them the calls with
+    the most rows; since every call costs one unit of the budget, taking them by value fills each window best
+    output: list of jobs with one API call each (see split_jobs) in the order they should run, each with its value
+    ('priority'), the hourly window it falls in ('window', 0 = the budget left now) and its expected start ('eta')
+    """
+    limiter = limiter if limiter is not None else rate_limiter
+    units = split_jobs(jobs)
+    for unit in units:
+        unit['priority'] = sum(call_priority(call, unit['frequency'], sla_reporters, sla_boost, half_life) for call in unit['calls'])
+    units.sort(key=lambda unit: -unit['priority'])
+
+    now_left, per_hour = hourly_budget(limiter)
+    n_calls = 0
+    for unit in units:
+        unit['window'] = 0 if n_calls < now_left else 1 + (n_calls - now_left) // per_hour
+        unit['eta'] = time.time() + estimate_wait_time(limiter, n_calls + 1)
+        n_calls += len(unit['calls'])
+    return units
+
+
+def print_schedule(units):
+    """
+    prints per hourly window of a schedule (see schedule_jobs) the number of API calls, their estimated rows and expected
+    start, and the expected completion time of the whole queue
+    """
+    for window, group in itertools.groupby(units, key=lambda unit: unit['window']):
+        group = list(group)
+        print('window {}: {} API call(s), ~{:,.0f} rows, from ~{:%d/%m/%Y %H:%M}'.format(window,
+            sum(len(unit['calls']) for unit in group), sum(call['rows'] for unit in group for call in unit['calls']),
+            datetime.datetime.fromtimestamp(group[0]['eta'])))
+    if units:
+        print('Queue of {} API call(s) expected to be done at ~{:%d/%m/%Y %H:%M}'.format(
+            sum(len(unit['calls']) for unit in units), datetime.datetime.fromtimestamp(units[-1]['eta'])))
+
+
+def store_files(root, output_format='csv'):
+    """
+    output: list of the csv files (also compressed) of a store directory, or of the data files of a columnar dataset
+    (hidden files and directories, e.g. staging directories and the response cache, are left out)
+    """
+    extensions = ('.csv', '.csv.gz', '.csv.bz2', '.csv.xz') if output_format == 'csv' else ('.' + output_format,)
+    paths = []
+    for dirpath, dirnames, files in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        paths += [os.path.join(dirpath, f) for f in sorted(files) if f.endswith(extensions) and not f.startswith('.')]
+    return paths
+
+
+def store_cells(root, output_format='csv', human_readable=False, products=None):
+    """
+    lists the product/ reporter/ partner/ trade flow/ period cells held by a store: a directory of csv files written by
+    download_trade_data or a columnar dataset (for which only the partition directory names are read)
+    products: dictionary file -> product parameters it was downloaded with (see store_products; default: from the names
+    of the files of a columnar dataset); a record counts for the first of them that requests its commodity code (see
+    record_products), records of files of unknown product are left out
+    output: dictionary (product, reporter, partner, tradeflow) -> dictionary period -> list of the files holding records of it
+    (all codes as strings, products in lower case)
+    """
+    files = store_files(root, output_format)
+    products = store_products(files) if products is None else products
+    columns = [result_columns[dim][1 if human_readable else 0] for dim in partition_dims]
+    product_column = result_columns['product'][1 if human_readable else 0]
+    cells = collections.defaultdict(lambda: collections.defaultdict(list))
+    for path in files:
+        if path not in products:
+            continue
+        if output_format == 'csv':
+            try:
+                df = pd.read_csv(path, usecols=columns + [product_column], dtype=str).drop_duplicates()
+            except (pd.errors.EmptyDataError, ValueError): # empty file of an empty dataset or not written by download_trade_data
+                continue
+            df['product'] = record_products(df[product_column], products[path])
+            keys = df[['product'] + columns].dropna().drop_duplicates().itertuples(index=False, name=None)
+        else:
+            parts = dict(part.split('=', 1) for part in os.path.relpath(os.path.dirname(path), root).split(os.sep) if '=' in part)
+            if not all(column in parts for column in columns):
+                continue
+            keys = [(product,) + tuple(parts[column] for column in columns) for product in products[path]]
+        for product, reporter, partner, tradeflow, period in keys:
+            holders = cells[product, reporter, partner, tradeflow][period]
+            if path not in holders:
+                holders.append(path)
+    return cells
+
+
+def record_products(codes, products):
+    """
+    output: series with the first of the product parameters of a file (see store_products) that requests each commodity
+    code of the series 'codes' (see product_mask), None for codes none of them requests
+    """
+    owners = pd.Series(None, index=codes.index, dtype=object)
+    for product in reversed(products):
+        owners[product_mask(codes, [product])] = product
+    return owners
+
+
+def latest_periods(cells, frequency='M'):
+    """
+    output: dictionary (product, reporter, partner, tradeflow) -> latest period stored (see store_cells) of the given frequency
+    """
+    latest = {}
+    for key, periods in cells.items():
+        periods = [p for p in periods if p.isdigit() and len(p) == (6 if frequency.lower() == 'm' else 4)]
+        if periods:
+            latest[key] = max(periods, key=lambda p: period_index(p, frequency))
+    return latest
+
+
+def last_complete_period(frequency='M', today=None):
+    """
+    output: the last month (YYYYMM) or year (YYYY) that is over
+    """
+    today = datetime.date.today() if today is None else today
+    if frequency.lower() == 'm':
+        return index_period(period_index(today.strftime('%Y%m'), 'm') - 1, 'm')
+    return str(today.year - 1)
+
+
+def refresh_job_spec(spec, cells, revision_window=3, until=None):
+    """
+    turns a job spec (see load_job_spec) into one that only requests what a store (see store_cells) is missing:
+    for every product/ reporter/ partner/ trade flow with records in the store, the periods after the latest one stored up
+    to 'until' (default: the last complete month/ year) plus the last revision_window periods stored, which the reporters
+    may have revised; products/ reporters/ partners/ trade flows without records in the store are requested with the
+    periods of the spec
+    output: job spec with one grid per product/ reporter/ partner/ trade flow (compile_job_spec merges them again)
+    """
+    grids = collections.OrderedDict()
+    for (frequency, product, tradeflow, reporter, partner, period), options in expand_job_spec(spec).items():
+        grid = grids.setdefault((frequency, product, tradeflow, reporter, partner), dict(options,
+            frequency=frequency, product=product, tradeflow=tradeflow, reporter=reporter, partner=partner, period=[]))
+        grid['period'].append(period)
+
+    latest = {}
+    for frequency in set(key[0] for key in grids):
+        latest[frequency] = latest_periods(cells, frequency)
+
+    jobs = []
+    for (frequency, product, tradeflow, reporter, partner), grid in grids.items():
+        stored = latest[frequency].get((product.lower(), reporter, partner, str(tradeflow)))
+        if stored is not None:
+            requested = [period_index(p, frequency) for p in grid['period'] if period_index(p, frequency) is not None]
+            start = period_index(stored, frequency) - revision_window + 1
+            start = max(start, min(requested)) if requested else start
+            end = period_index(until or last_complete_period(frequency), frequency)
+            if end < start:
+                continue
+            grid['period'] = ['{}-{}'.format(index_period(start, frequency), index_period(end, frequency))]
+        jobs.append(grid)
+    return dict({key: value for key, value in spec.items() if key not in ['jobs']}, jobs=jobs)
+
+
+def prune_csv_store(root, cells, keep, products):
+    """
+    removes the records of the given cells (product, reporter, partner, tradeflow, period as strings) from every csv file
+    of a store except the file 'keep', which holds their new version; files left without records are deleted
+    products: dictionary file -> product parameters it was downloaded with (see store_products); a record belongs to the
+    cell of the first of them that requests its commodity code, records of files of unknown product are kept
+    """
+    cells = set((str(cell[0]).lower(),) + tuple(map(str, cell[1:])) for cell in cells)
+    for path in store_files(root, 'csv'):
+        if os.path.abspath(path) == os.path.abspath(keep) or path not in products:
+            continue
+        try:
+            df = pd.read_csv(path, index_col=0, dtype=str, keep_default_na=False)
+        except pd.errors.EmptyDataError:
+            continue
+        columns = [result_columns[dim][1 if 'Reporter Code' in df.columns else 0] for dim in ['product'] + partition_dims]
+        if not all(column in df.columns for column in columns):
+            continue
+        owners = record_products(df[columns[0]], products[path])
+        stale = [cell in cells for cell in zip(owners, *[df[column] for column in columns[1:]])]
+        if not any(stale):
+            continue
+        df = df[[not s for s in stale]]
+        if len(df) == 0:
+            os.remove(path)
+            continue
+        tmp_path = os.path.join(os.path.dirname(path), '.tmp-' + os.path.basename(path)) # same extension = same compression
+        df.to_csv(tmp_path)
+        os.replace(tmp_path, path)
+
+
+def run_refresh(spec, store, output_format='csv', revision_window=3, until=None, **options):
+    """
+    incremental refresh of a store (see refresh_job_spec): downloads only the new periods and the last revision_window
+    periods of every product/ reporter/ partner/ trade flow and merges them into the store
+    - csv: the new files are written to the directory 'store' (one per product, see default_output), the refreshed records
+      are removed from the older files of the same product
+    - 'parquet'/ 'arrow': the files of the refreshed periods and products are replaced in the dataset 'store'
+    responses cached before the refresh are not used, since the API may have revised them
+    options: further arguments of run_compiled_jobs/ download_trade_data
+    output: number of API calls
+    """
+    human_readable = options.get('human_readable', False)
+    products = store_products(store_files(store, output_format), options.get('ledger') or job_ledger)
+    cells = store_cells(store, output_format, human_readable, products)
+    refresh = refresh_job_spec(spec, cells, revision_window, until)
+    output = os.path.join(store, default_output) if output_format == 'csv' else store
+    jobs = compile_job_spec(refresh, output)
+    print_compiled_jobs(jobs)
+
+    cache = options.get('cache') or response_cache
+    started = time.time()
+    if cache is not None:
+        not_before, cache['not_before'] = cache['not_before'], started
+    try:
+        r = run_compiled_jobs(jobs, skip=(), output_format=output_format, **options)
+    finally:
+        if cache is not None:
+            cache['not_before'] = not_before
+
+    if output_format == 'csv':
+        for job in jobs:
+            if os.path.exists(job['filename']) and os.path.getmtime(job['filename']) >= started:
+                prune_csv_store(store, [[product] + cell for call in job['calls'] for cell in call['cells']
+                    for product in as_code_list(job['product'])], job['filename'], products)
+    return r
+
+
+def store_products(files, ledger=None, outputs=None):
+    """
+    finds out which product parameter the files of a store were downloaded with: for the files of a columnar dataset from
+    their names (see product_tag), for csv files from the parameters of their job in the ledger (see mk_job_ledger) or
+    else from their names (see filename_params)
+    files: files of the store (see store_files)
+    outputs: templates of the names of the csv files (default: store_outputs)
+    output: dictionary file -> list of the product codes (in lower case, as in product_tag); files whose product is
+    unknown are left out
+    """
+    jobs = {}
+    if ledger is not None:
+        with ledger['lock']:
+            rows = ledger['conn'].execute('SELECT params FROM jobs WHERE params IS NOT NULL').fetchall()
+        jobs = dict((os.path.abspath(params['filename']), params.get('product')) for params in (json.loads(row[0]) for row in rows))
+    products = {}
+    for path in files:
+        if path.endswith(('.parquet', '.arrow')):
+            product = file_product(path)
+        else:
+            product = jobs.get(os.path.abspath(path))
+            if product is None:
+                product = (filename_params(path, outputs) or {}).get('product')
+            product = product_tag(product) if product is not None else None
+        if product is not None:
+            products[path] = product.split(',')
+    return products
+
+
+def mk_coverage_index(cells=None):
+    """
+    creates an index of the cells a store holds: per frequency/ product/ trade flow/ reporter/ partner a sorted list of
+    disjoint period intervals, so that a cell or a range of periods is looked up by bisection
+    cells: cells of a store (see store_cells, which reads every file; cells held only by files of unknown product are not
+    listed, i.e. they are downloaded again); ledger_coverage and filename_coverage fill the index without reading the files
+    output: dictionary with the intervals (pass it to compile_job_spec, is_covered, add_coverage)
+    """
+    index = {'intervals': {}} # (frequency, product, tradeflow, reporter, partner) -> [[start, end], ...] (see period_index)
+    for (product, reporter, partner, tradeflow), periods in (cells or {}).items():
+        for period in periods:
+            if str(period).isdigit():
+                add_coverage(index, ('M' if len(period) == 6 else 'A', product, tradeflow, reporter, partner), period, period)
+    return index
+
+
+def add_job_coverage(index, params):
+    """
+    marks all cells of a job (parameters of download_trade_data: reporter, partner, tradeflow, period, product and
+    frequency) as stored; special periods like 'recent' are left out
+    """
+    frequency = params.get('frequency', 'A')
+    periods = [p for p in transform_period(as_code_list(params['period']), frequency) if period_index(p, frequency) is not None]
+    for product, reporter, partner in itertools.product(*[as_code_list(params[dim]) for dim in ['product', 'reporter', 'partner']]):
+        for period in periods:
+            add_coverage(index, (frequency, product, params['tradeflow'], reporter, partner), period, period)
+
+
+def ledger_coverage(index, ledger, states=('done', 'empty')):
+    """
+    adds the cells of every job the ledger lists in one of the given states to a coverage index (one query; only the
+    output of the job is checked for existence, its records are not read)
+    """
+    with ledger['lock']:
+        rows = ledger['conn'].execute('SELECT state, params FROM jobs WHERE params IS NOT NULL AND state IN ({})'.format(
+            ', '.join('?' * len(states))), list(states)).fetchall()
+    for state, params in rows:
+        params = json.loads(params)
+        if state == 'empty' or os.path.exists(params['filename']): # an empty job writes no file
+            add_job_coverage(index, params)
+
+
+def filename_params(path, outputs=None):
+    """
+    reads the parameters of the job that wrote a csv file from its name
+    outputs: list of (template of the filenames as in compile_job_spec, parameters the template leaves out) tried in turn
+    (default: store_outputs); the frequency is taken from the length of the periods if neither gives it
+    output: dictionary with the parameters (several codes as lists), None if the name matches none of the templates
+    """
+    name = os.path.basename(path)
+    for template, defaults in store_outputs if outputs is None else outputs:
+        parts = re.split(r'\{(\w+)\}', os.path.basename(template)) # literal text, field, literal text, ...
+        pattern = ''.join(re.escape(part) if i % 2 == 0 else '(?P={})'.format(part) if part in parts[1:i:2]
+            else '(?P<{}>[^_]+)'.format(part) for i, part in enumerate(parts))
+        match = re.fullmatch(pattern, name)
+        if match is None:
+            continue
+        params = dict(defaults, **{dim: value.split('+') for dim, value in match.groupdict().items()})
+        for dim in ['tradeflow', 'frequency']:
+            if isinstance(params.get(dim), list):
+                params[dim] = params[dim][0]
+        if 'tradeflow' in params:
+            names = dict((tradeflow_name.lower(), code) for code, tradeflow_name in tradeflow_names.items())
+            params['tradeflow'] = names.get(params['tradeflow'].lower(), transform_tradeflow(params['tradeflow']))
+        if 'frequency' not in params and 'period' in params:
+            params['frequency'] = 'M' if len(params['period'][0].split('-')[0]) == 6 else 'A'
+        if all(dim in params for dim in spec_dims):
+            return params
+    return None
+
+
+def filename_coverage(index, root, outputs=None):
+    """
+    adds the cells of the csv files of a store to a coverage index, read from their names (see filename_params), e.g. for
+    files written before there was a ledger; files whose names match none of the templates are left out
+    """
+    for path in store_files(root, 'csv'):
+        params = filename_params(path, outputs)
+        if params is not None:
+            add_job_coverage(index, params)
+
+
+def coverage_key(key):
+    frequency, product, tradeflow, reporter, partner = key
+    return (frequency.upper(), str(product).lower(), str(transform_tradeflow(tradeflow)), str(reporter), str(partner))
+
+
+def add_coverage(index, key, start, end):
+    """
+    marks the periods start to end (YYYY or YYYYMM) of key (frequency, product, tradeflow, reporter, partner) as stored,
+    merging them with overlapping or adjacent intervals
+    """
+    key = coverage_key(key)
+    start, end = period_index(start, key[0]), period_index(end, key[0])
+    intervals = index['intervals'].setdefault(key, [])
+    i = bisect.bisect_left(intervals, [start, start])
+    if i > 0 and intervals[i - 1][1] >= start - 1: # touches the interval before
+        i -= 1
+    j = i
+    while j < len(intervals) and intervals[j][0] <= end + 1:
+        start, end = min(start, intervals[j][0]), max(end, intervals[j][1])
+        j += 1
+    intervals[i:j] = [[start, end]]
+
+
+def covered_interval(index, key, period):
+    """
+    output: [start, end] of the stored interval of key containing period, None if the period is not stored
+    """
+    key = coverage_key(key)
+    position = period_index(period, key[0])
+    intervals = index['intervals'].get(key, [])
+    if position is None:
+        return None
+    i = bisect.bisect_right(intervals, [position, float('inf')]) - 1
+    return intervals[i] if i >= 0 and intervals[i][0] <= position <= intervals[i][1] else None
+
+
+def is_covered(index, cell):
+    """
+    cell: (frequency, product, tradeflow, reporter, partner, period) as listed by expand_job_spec
+    output: True if the store holds the cell
+    """
+    return covered_interval(index, cell[:5], cell[5]) is not None
+
+
+def coverage_gaps(index, key, start, end):
+    """
+    output: list of the ranges ('YYYYMM-YYYYMM' or single periods) between start and end that the store does not hold for key
+    """
+    key = coverage_key(key)
+    start, end = period_index(start, key[0]), period_index(end, key[0])
+    gaps = []
+    for interval in index['intervals'].get(key, []) + [[end + 1, end + 1]]:
+        if interval[0] > start and start <= end:
+            gaps.append(list(range(start, min(interval[0] - 1, end) + 1)))
+        start = max(start, interval[1] + 1)
+    return coalesce_periods([index_period(p, key[0]) for gap in gaps for p in gap], key[0])
+
+
+def print_coverage(index):
+    """
+    prints the stored period ranges of every frequency/ product/ trade flow/ reporter/ partner
+    """
+    for key, intervals in sorted(index['intervals'].items()):
+        ranges = ['-'.join(sorted(set([index_period(s, key[0]), index_period(e, key[0])]))) for s, e in intervals]
+        print('freq={} cc={} rg={} r={} p={}: {}'.format(*key, ', '.join(ranges)))
+
+
+def mk_rate_limiter(rps=1, rph=100, state_file=None):
+    """
+    creates a token bucket rate limiter enforcing both API limits at once:
+    - rps: requests per second (bucket of size 1, refilled at rps tokens per second)
+    - rph: requests per hour (bucket of size rph, refilled at rph tokens per hour)
+    state_file: optional json file in which the bucket levels are saved after every call, so that
+    a restarted driver does not start again with a full hourly budget
+    output: dictionary with the state of both buckets (pass it to acquire_token)
+    """
+    now = time.time()
+    limiter = {
+        'buckets': {
+            'second': {'capacity': 1, 'rate': float(rps), 'tokens': 1.0},
+            'hour': {'capacity': rph, 'rate': rph / 3600.0, 'tokens': float(rph)},
+        },
+        'updated': now,
+        'hold_until': 0, # no call before this time, e.g. after the API blocked requests (see hold_tokens)
+        'state_file': state_file,
+        'lock': threading.Lock(),
+    }
+
+    if state_file is not None:
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = None
+        if state:
+            limiter['updated'] = min(state['updated'], now)
+            limiter['hold_until'] = state.get('hold_until', 0)
+            for name, tokens in state['tokens'].items():
+                if name in limiter['buckets']:
+                    limiter['buckets'][name]['tokens'] = min(tokens, limiter['buckets'][name]['capacity'])
+
+    return limiter
+
+
+def refill_buckets(limiter, now=None):
+    """
+    adds the tokens earned since the last update to every bucket of the limiter (up to its capacity)
+    """
+    now = time.time() if now is None else now
+    elapsed = max(now - limiter['updated'], 0)
+    for bucket in limiter['buckets'].values():
+        bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + elapsed * bucket['rate'])
+    limiter['updated'] = now
+
+
+def token_wait_time(limiter):
+    """
+    output: number of seconds until every bucket of the limiter holds at least one token (0 if a call may go out now)
+    """
+    refill_buckets(limiter)
+    wait = max(max(1 - bucket['tokens'], 0) / bucket['rate'] for bucket in limiter['buckets'].values())
+    return max(wait, limiter['hold_until'] - limiter['updated'])
+
+
+def acquire_token(limiter, verbose=False):
+    """
+    blocks until the limiter allows another API call and takes one token from every bucket
+    output: number of seconds spent waiting
+    """
+    waited = 0
+    while True:
+        with limiter['lock']:
+            wait = token_wait_time(limiter)
+            if wait <= 0:
+                for bucket in limiter['buckets'].values():
+                    bucket['tokens'] -= 1
+                save_limiter_state(limiter)
+                return waited
+        if verbose and wait > 60:
+            resuming_at = datetime.datetime.strftime(datetime.datetime.today() + datetime.timedelta(seconds=wait), '%d/%m/%Y:%H:%M:%S')
+            print("Rate limit reached, resuming at {}".format(resuming_at))
+        sleep(wait)
+        waited += wait
+
+
+def estimate_wait_time(limiter, n_calls):
+    """
+    output: estimated number of seconds the limiter (or token pool) needs to let n_calls API calls go out
+    """
+    if 'members' in limiter:
+        return estimate_pool_wait_time(limiter, n_calls)
+    with limiter['lock']:
+        refill_buckets(limiter)
+        return max(max(n_calls - bucket['tokens'], 0) / bucket['rate'] for bucket in limiter['buckets'].values())
+
+
+def drain_tokens(limiter):
+    """
+    empties every bucket of the limiter, e.g. after the API reported that the usage limit was hit
+    (the next call then goes out as soon as one token has been earned back, not after a fixed hour)
+    """
+    with limiter['lock']:
+        refill_buckets(limiter)
+        for bucket in limiter['buckets'].values():
+            bucket['tokens'] = min(bucket['tokens'], 0)
+        save_limiter_state(limiter)
+
+
+def hold_tokens(limiter, seconds):
+    """
+    lets no call through the limiter for the next 'seconds' seconds (the API told us when requests may resume)
+    """
+    with limiter['lock']:
+        limiter['hold_until'] = max(limiter['hold_until'], time.time() + seconds)
+        save_limiter_state(limiter)
+
+
+def save_limiter_state(limiter):
+    """
+    writes the bucket levels of the limiter to its state file (if it has one)
+    """
+    if limiter['state_file'] is None:
+        return
+    state = {
+        'updated': limiter['updated'],
+        'tokens': {name: bucket['tokens'] for name, bucket in limiter['buckets'].items()},
+        'hold_until': limiter['hold_until'],
+    }
+    tmp_file = limiter['state_file'] + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, limiter['state_file'])
+
+
+def mk_token_pool(tokens, rps=1, rph=10000, state_dir=None):
+    """
+    creates a pool of API tokens (subscriptions), each with its own rate limiter, so that API calls go out on whichever
+    token has budget left and a 409 for one token does not hold back the others
+    tokens: list of tokens or of dictionaries {'token': ..., 'rps': ..., 'rph': ...} for tokens with other limits
+    rps, rph: limits of every token (the API allows authenticated users 1 request per second and 10 000 per hour)
+    state_dir: directory in which the state of every token's limiter is saved (see mk_rate_limiter), under a hash of the token
+    output: dictionary with the members of the pool (pass it as limiter to download_trade_data)
+    """
+    members = []
+    for token in tokens:
+        token = token if isinstance(token, dict) else {'token': token}
+        state_file = None
+        if state_dir is not None:
+            state_file = os.path.join(state_dir, '.rate_limiter-{}.json'.format(hashlib.sha256(token['token'].encode('utf-8')).hexdigest()[:12]))
+        members.append({'token': token['token'],
+            'limiter': mk_rate_limiter(token.get('rps', rps), token.get('rph', rph), state_file)})
+    if not members:
+        raise ValueError('A token pool needs at least one token.')
+    return {'members': members, 'lock': threading.Lock()}
+
+
+def acquire_pool_token(pool, verbose=False):
+    """
+    blocks until one token of the pool may make another API call and takes one token from its limiter
+    (the member that can go first; tokens held after a 409 are passed over)
+    output: (member of the pool, number of seconds spent waiting)
+    """
+    waited = 0
+    while True:
+        with pool['lock']:
+            waits = []
+            for member in pool['members']:
+                with member['limiter']['lock']:
+                    waits.append(token_wait_time(member['limiter']))
+            member = pool['members'][int(np.argmin(waits))]
+            if min(waits) <= 0:
+                with member['limiter']['lock']:
+                    for bucket in member['limiter']['buckets'].values():
+                        bucket['tokens'] -= 1
+                    save_limiter_state(member['limiter'])
+                return member, waited
+        wait = min(waits)
+        if verbose and wait > 60:
+            resuming_at = datetime.datetime.strftime(datetime.datetime.today() + datetime.timedelta(seconds=wait), '%d/%m/%Y:%H:%M:%S')
+            print("Rate limit of every token reached, resuming at {}".format(resuming_at))
+        sleep(wait)
+        waited += wait
+
+
+def estimate_pool_wait_time(pool, n_calls):
+    """
+    output: estimated number of seconds the tokens of the pool together need to let n_calls API calls go out
+    """
+    wait = 0
+    for name in ['second', 'hour']:
+        tokens, rate = 0.0, 0.0
+        for member in pool['members']:
+            limiter = member['limiter']
+            with limiter['lock']:
+                refill_buckets(limiter)
+                if limiter['hold_until'] <= limiter['updated']:
+                    tokens += limiter['buckets'][name]['tokens']
+                rate += limiter['buckets'][name]['rate']
+        wait = max(wait, max(n_calls - tokens, 0) / rate)
+    return wait
+
+
+def error_limiter(limiter, e):
+    """
+    output: the limiter to hold after the error e: for a token pool the limiter of the token of the failed request
+    (read from its URL), otherwise the limiter itself
+    """
+    if 'members' not in limiter:
+        return limiter
+    response = getattr(e, 'response', None)
+    query = parse_qs(urlparse(response.url).query) if response is not None and response.url else {}
+    token = query.get('token', [None])[0]
+    for member in limiter['members']:
+        if member['token'] == token:
+            return member['limiter']
+    return limiter['members'][0]['limiter']
+
+
+def redact_token(text):
+    """
+    output: text (e.g. an error message containing the request URL) with API tokens replaced by '***'
+    """
+    return re.sub(r'token=[^&\s]+', 'token=***', text)
+
+
+def pool_stats(pool):
+    """
+    output: list with the tokens left in the hourly bucket and the seconds until the next call of every token of the pool
+    (tokens shortened to their last 4 characters)
+    """
+    stats = []
+    for member in pool['members']:
+        with member['limiter']['lock']:
+            wait = token_wait_time(member['limiter'])
+            stats.append({'token': '...' + member['token'][-4:], 'hourly_left': int(member['limiter']['buckets']['hour']['tokens']),
+                'wait_s': wait})
+    return stats
+
+
+# upper bounds (seconds) of the buckets of the latency histograms
+latency_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# type and description of the metrics recorded by the downloader (see mk_metrics)
+metric_help = {
+    'comtrade_requests_total': ('counter', 'API requests sent, by HTTP status (error = no response)'),
+    'comtrade_request_seconds': ('histogram', 'time from sending an API request until the last byte of the response'),
+    'comtrade_response_bytes_total': ('counter', 'bytes of responses read, by source (api or cache)'),
+    'comtrade_cache_lookups_total': ('counter', 'response cache lookups, by result (hit or miss)'),
+    'comtrade_rows_parsed_total': ('counter', 'records parsed from responses'),
+    'comtrade_parse_seconds': ('histogram', 'time spent parsing one response'),
+    'comtrade_parse_fallbacks_total': ('counter', 'responses of the download pipeline parsed in-process after the process pool failed'),
+    'comtrade_limiter_wait_seconds': ('histogram', 'time an API call waited for the rate limiter'),
+    'comtrade_retries_total': ('counter', 'API calls repeated, by kind of error (see classify_error)'),
+    'comtrade_jobs_total': ('counter', 'jobs (download_trade_data calls) finished, by state'),
+    'comtrade_job_seconds': ('histogram', 'duration of one job'),
+}
+
+
+def mk_metrics(json_file=None, flush_interval=60):
+    """
+    creates a registry for the metrics of the downloader (counters and histograms, see metric_help)
+    json_file: optional file the metrics are written to by flush_metrics, at most every flush_interval seconds
+    output: dictionary holding the metrics (pass it to count_metric, observe_metric, metrics_text, serve_metrics)
+    """
+    return {
+        'counters': {},   # (name, labels) -> value
+        'histograms': {}, # (name, labels) -> {'buckets': [...], 'counts': [...], 'sum': ..., 'count': ...}
+        'started': time.time(),
+        'json_file': json_file,
+        'flush_interval': flush_interval,
+        'flushed': time.time(),
+        'lock': threading.Lock(),
+    }
+
+
+def count_metric(metrics, name, value=1, **labels):
+    """
+    adds value to the counter 'name' with the given labels (e.g. status=200)
+    """
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with metrics['lock']:
+        metrics['counters'][key] = metrics['counters'].get(key, 0) + value
+
+
+def observe_metric(metrics, name, value, buckets=latency_buckets, **labels):
+    """
+    adds one observation (e.g. a latency in seconds) to the histogram 'name' with the given labels
+    """
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with metrics['lock']:
+        histogram = metrics['histograms'].get(key)
+        if histogram is None:
+            histogram = metrics['histograms'][key] = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+        i = next((i for i, bound in enumerate(histogram['buckets']) if value <= bound), len(histogram['buckets']))
+        histogram['counts'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def metric_total(metrics, name, **labels):
+    """
+    output: sum of the counter (or of the observations of the histogram) 'name' over all labels matching the given ones
+    """
+    wanted = set((k, str(v)) for k, v in labels.items())
+    with metrics['lock']:
+        counters = sum(v for (n, l), v in metrics['counters'].items() if n == name and wanted <= set(l))
+        histograms = sum(h['sum'] for (n, l), h in metrics['histograms'].items() if n == name and wanted <= set(l))
+    return counters + histograms
+
+
+def metrics_summary(metrics):
+    """
+    output: dictionary with the totals that tell whether downloading is network-, CPU- or quota-bound
+    (seconds spent on requests, parsing and waiting for the rate limiter) and the cache hit ratio
+    """
+    hits = metric_total(metrics, 'comtrade_cache_lookups_total', result='hit')
+    lookups = metric_total(metrics, 'comtrade_cache_lookups_total')
+    return {
+        'uptime_s': time.time() - metrics['started'],
+        'requests': metric_total(metrics, 'comtrade_requests_total'),
+        'network_s': metric_total(metrics, 'comtrade_request_seconds'),
+        'parse_s': metric_total(metrics, 'comtrade_parse_seconds'),
+        'limiter_wait_s': metric_total(metrics, 'comtrade_limiter_wait_seconds'),
+        'retries': metric_total(metrics, 'comtrade_retries_total'),
+        'bytes': metric_total(metrics, 'comtrade_response_bytes_total'),
+        'rows': metric_total(metrics, 'comtrade_rows_parsed_total'),
+        'cache_hit_ratio': hits / lookups if lookups else 0.0,
+    }
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + [(k, str(v)) for k, v in extra.items()]
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}' if labels else ''
+
+
+def metrics_text(metrics):
+    """
+    output: the metrics in the Prometheus text exposition format
+    """
+    with metrics['lock']:
+        counters = dict(metrics['counters'])
+        histograms = {key: dict(h, counts=list(h['counts'])) for key, h in metrics['histograms'].items()}
+    lines = []
+    for name, (kind, description) in metric_help.items():
+        lines += ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, kind)]
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for (n, labels), h in sorted(histograms.items()):
+            if n == name:
+                cumulative = list(itertools.accumulate(h['counts']))
+                for bound, count in zip(h['buckets'] + ['+Inf'], cumulative):
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=bound), count))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), h['sum']))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), h['count']))
+    lines += ['# HELP comtrade_cache_hit_ratio share of response cache lookups that were hits', '# TYPE comtrade_cache_hit_ratio gauge',
+              'comtrade_cache_hit_ratio {}'.format(metrics_summary(metrics)['cache_hit_ratio'])]
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_json(metrics):
+    """
+    output: dictionary of all metrics (histograms with cumulative bucket counts) and the summary (see metrics_summary)
+    """
+    with metrics['lock']:
+        counters = {name + format_labels(labels): value for (name, labels), value in metrics['counters'].items()}
+        histograms = {name + format_labels(labels): {
+                'count': h['count'], 'sum': h['sum'],
+                'buckets': dict(zip(map(str, h['buckets'] + ['+Inf']), itertools.accumulate(h['counts'])))}
+            for (name, labels), h in metrics['histograms'].items()}
+    return {'time': time.time(), 'summary': metrics_summary(metrics), 'counters': counters, 'histograms': histograms}
+
+
+def flush_metrics(metrics, force=False):
+    """
+    writes the metrics to the json file of the registry (if it has one) when flush_interval seconds have passed since
+    the last time (or always with force = True), e.g. after every job of the driver
+    """
+    if metrics['json_file'] is None or not (force or time.time() - metrics['flushed'] >= metrics['flush_interval']):
+        return
+    metrics['flushed'] = time.time()
+    tmp_file = metrics['json_file'] + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(metrics_json(metrics), f, indent=1)
+    os.replace(tmp_file, metrics['json_file'])
+
+
+def serve_metrics(metrics, port=9108, host='127.0.0.1'):
+    """
+    serves the metrics on a background thread: http://host:port/metrics in the Prometheus text format and
+    http://host:port/metrics.json as json
+    host: '127.0.0.1' serves only this machine, '0.0.0.0' every network interface (e.g. for a Prometheus on another host)
+    output: the HTTP server (call server.shutdown() to stop it); raises OSError if the port is in use
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith('/metrics.json'):
+                body, content_type = json.dumps(metrics_json(metrics)), 'application/json'
+            elif self.path.startswith('/metrics'):
+                body, content_type = metrics_text(metrics), 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404)
+                return
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# defaults used when no limiter, session, cache or ledger is passed to the functions above
+# (the driver below replaces them by persistent ones); every function records its metrics in download_metrics
+rate_limiter = mk_rate_limiter()
+http_session = mk_session()
+response_cache = None
+job_ledger = None
+download_metrics = mk_metrics()
 
 
 # In[5]:
 
 
 #Call details 1
-trade_flows = ['import','Export']
-reporters = ['682'] #USA 842
-partners = ['660'] #Saudi 682
-# periods = ['201001-201005','201006-201010','201011-201103','201104-201108','201109-201201','201202-201206',
-#            '201207-201211','201212-201304','201305-201309','201310-201312']
-periods = ['201607-201611']
-# periods = ['201401-201405','201406-201410','201411-201503','201504-201508','201509-201601','201602-201606',
-#            '201607-201611','201612-201704','201705-201709','201710-201712','201801-201805','201806-201810',
-#            '201811-201812','201001-201005','201006-201010','201011-201103','201104-201108','201109-201201',
-#            '201202-201206','201207-201211','201212-201304','201305-201309','201310-201312']
-periods.reverse()
+# the grid of cells to download; load_job_spec reads the same structure from a json/ yaml file
+job_spec_file = None # e.g. "/var/log/cadabra/jobs.yaml", replaces job_spec below
+job_spec = {
+    'output': '/var/log/cadabra/{partner}_{tradeflow}_{period}_{reporter}_{product}.csv',
+    #/Users/NajlaAlqahtani/Downloads/cadabra/
+    'frequency': 'M',
+    'product': 'all',
+    'jobs': [{
+        'tradeflow': ['import', 'Export'],
+        'reporter': ['682'], #USA 842
+        'partner': ['660'], #Saudi 682
+        # adjacent ranges are coalesced and split into API calls by compile_job_spec, e.g.
+        # 'period': ['201001-201005','201006-201010','201011-201103','201104-201108','201109-201201','201202-201206',
+        #            '201207-201211','201212-201304','201305-201309','201310-201312'],
+        'period': ['201607-201611'],
+    }],
+}
+
+rph = 95 # stay a bit below the guest limit of 100 requests per hour
+
+# subscription tokens (comma separated in the environment variable COMTRADE_TOKENS); without tokens the guest limits apply
+api_tokens = [token for token in os.environ.get('COMTRADE_TOKENS', '').split(',') if token]
+
+metrics_port = 9108 # HTTP endpoint of the metrics (see serve_metrics), None = only the file metrics.json
+metrics_host = '127.0.0.1' # '0.0.0.0' in order to let a Prometheus on another host scrape them
+
+refresh = False # True: download only the periods after the latest one stored plus the last revision_window periods (see run_refresh)
+revision_window = 3
+
+sla_reporters = [] # reporters whose data is downloaded first (see schedule_jobs)
 
 
 # In[6]:
 
 
 #call funct1 => resulted HS code combined
-i=0
-r=0
-rph = 95
-wait_s = 60*60
-for part in partners:
-    for tf in trade_flows:
-        for p in periods:
-            for rep in reporters:
-                print(i)
-                file = '{}_{}_{}_{}.csv'.format(part,tf,p,rep)
-                my_file = "/var/log/cadabra/"+file
-                #/Users/NajlaAlqahtani/Downloads/cadabra/
-                #my_file = Path(file)
-                try:
-                    f = open(my_file)
-                    print("the file {} exists".format(file))
-                except:
-                    print('Requesting data for {}...'.format(file))
-                    try:
-                        reqs = download_trade_data(my_file, period=p, frequency='M', reporter=rep, 
-                                                   partner=part, product='all', tradeflow=tf)
-                    except Exception as e: 
-                        print(e)
-                        print("There was a problem downloading the data")
-                        if "Expecting" in str(e):
-                            wakingup_at = datetime.datetime.strftime(datetime.datetime.today() + datetime.timedelta(seconds = wait_s) , '%d/%m/%Y:%H:%M')
-                            print("Sleeping for an hour, resuming at {}".format(wakingup_at))
-                            sleep(wait_s)
-                        sleep(1)
-                    else:
-                        r += reqs if reqs > 0 else 1
-                        print("{} requests this session".format(r))
-                        sleep(1)
-            
-                i += 1
+# (only when run as a script, so that the functions can be imported, e.g. by comtrade_benchmark.py)
+if __name__ == '__main__':
+    if api_tokens:
+        rate_limiter = mk_token_pool(api_tokens, rps=1, rph=10000, state_dir="/var/log/cadabra")
+    else:
+        rate_limiter = mk_rate_limiter(rps=1, rph=rph, state_file="/var/log/cadabra/.rate_limiter.json")
+    http_session = mk_session(pool_size=max(10, len(api_tokens)))
+    job_ledger = mk_job_ledger("/var/log/cadabra/jobs.sqlite")
+    response_cache = mk_response_cache("/var/log/cadabra/.cache", max_bytes=2 * 1024**3, ttl=30 * 24 * 60 * 60)
+    download_metrics = mk_metrics("/var/log/cadabra/metrics.json", flush_interval=60)
+    if metrics_port:
+        try:
+            serve_metrics(download_metrics, metrics_port, metrics_host) # scrape http://localhost:<metrics_port>/metrics
+        except OSError as e: # e.g. port in use: download anyway, the metrics are still written to metrics.json
+            print('Warning: cannot serve the metrics on {}:{} ({}).'.format(metrics_host, metrics_port, e))
+
+    spec = load_job_spec(job_spec_file) if job_spec_file else job_spec
+    if refresh:
+        r = run_refresh(spec, "/var/log/cadabra", 'csv', revision_window, workers=max(1, len(api_tokens)))
+    else:
+        # cells stored by earlier jobs, whatever period ranges they were requested in, are not downloaded again:
+        # from the ledger and, for files written before there was one, from the names of the files
+        coverage = mk_coverage_index()
+        ledger_coverage(coverage, job_ledger)
+        filename_coverage(coverage, "/var/log/cadabra", [(spec.get('output', default_output), {})] + store_outputs)
+        jobs = compile_job_spec(spec, coverage=coverage)
+        print_compiled_jobs(jobs, rate_limiter)
+        save_compiled_jobs(jobs, "/var/log/cadabra/jobs.json") # which API call covers which cells
+        jobs = schedule_jobs(jobs, rate_limiter, sla_reporters) # recent periods and SLA reporters first
+        print_schedule(jobs)
+        # jobs the ledger lists as done are skipped; one call in flight per token
+        r = run_compiled_jobs(jobs, coverage=coverage, workers=max(1, len(api_tokens)))
+
+    flush_metrics(download_metrics, force=True)
+    print("network {network_s:.0f} s, parsing {parse_s:.0f} s, waiting for the rate limiter {limiter_wait_s:.0f} s, "
+          "{retries:.0f} retries".format(**metrics_summary(download_metrics)))
 
 
 # In[ ]: